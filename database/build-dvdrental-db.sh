@@ -0,0 +1,40 @@
+#!/bin/sh
+# Runs at image build time. Restores dvdrental.tar into a temporary cluster once and
+# keeps what the selected DVDRENTAL_PROVISION mode needs under /var/lib/pgsql/dvdrental:
+#   dump   - directory-format dump, pg_restore can only run parallel jobs on this format
+#   pgdata - the restored data directory (baked mode only)
+
+set -e
+target=/var/lib/pgsql/dvdrental
+mkdir -p $target
+
+if [ "$DVDRENTAL_PROVISION" = "restore" ]
+then
+    echo "restore mode, nothing to prepare."
+    exit 0
+fi
+
+cluster=$target/pgdata
+initdb -D $cluster -U postgres --auth=trust
+pg_ctl -D $cluster -o "-c listen_addresses='' -c unix_socket_directories=/tmp" -w start
+createdb -h /tmp -U postgres dvdrental
+pg_restore -h /tmp -U postgres -d dvdrental /tmp/dvdrental.tar
+pg_dump -h /tmp -U postgres -Fd -j 4 -f $target/dump dvdrental
+pg_ctl -D $cluster -w stop -m fast
+
+if [ "$DVDRENTAL_PROVISION" = "baked" ]
+then
+    # the same configuration the image adds when it initializes a new data directory,
+    # written literally since POSTGRESQL_CONFIG_FILE is only set by the runtime scripts
+    cat >> $cluster/postgresql.conf <<EOCONF
+# Custom OpenShift configuration:
+include '/var/lib/pgsql/openshift-custom-postgresql.conf'
+EOCONF
+    cat >> $cluster/pg_hba.conf <<EOCONF
+# Allow connections from all hosts.
+host all all all md5
+EOCONF
+else
+    rm -rf $cluster
+fi
+echo "dvdrental $DVDRENTAL_PROVISION artifacts prepared."
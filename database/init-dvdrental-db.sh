@@ -9,8 +9,20 @@ then
       CREATE DATABASE dvdrental;
 EOSQL
   echo "DVD rental database created."
-  echo "Restoring DVD rental data from dvdrental.tar..."
-  pg_restore -U postgres -d dvdrental /tmp/dvdrental.tar
+  dump=/var/lib/pgsql/dvdrental/dump
+  if [ "$DVDRENTAL_PROVISION" != "restore" ] && [ -d $dump ]
+  then
+    restore_jobs=${DVDRENTAL_RESTORE_JOBS:-4}
+    echo "Restoring DVD rental data from the directory dump with $restore_jobs jobs..."
+    # schema first, then the table data in parallel, then indexes, constraints and
+    # triggers once all the data is loaded
+    pg_restore -U postgres -d dvdrental --section=pre-data $dump
+    pg_restore -U postgres -d dvdrental --section=data -j $restore_jobs $dump
+    PGOPTIONS='-c maintenance_work_mem=256MB' pg_restore -U postgres -d dvdrental --section=post-data -j $restore_jobs $dump
+  else
+    echo "Restoring DVD rental data from dvdrental.tar..."
+    pg_restore -U postgres -d dvdrental /tmp/dvdrental.tar
+  fi
   echo "DVD rental database restore completed."
 else
   echo "dvd rental database exists!!!! Skip creating."
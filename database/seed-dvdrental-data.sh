@@ -0,0 +1,14 @@
+#!/bin/sh
+# Sourced by the image before the server starts. In baked mode an empty data
+# volume is seeded with the data directory restored at build time, so the image
+# skips initdb and the container starts with the dvdrental database in place.
+
+baked_data=/var/lib/pgsql/dvdrental/pgdata
+if [ "$DVDRENTAL_PROVISION" = "baked" ] && [ -d $baked_data ] && [ ! -f "$PGDATA/postgresql.conf" ]
+then
+    echo "Seeding $PGDATA with the baked dvdrental data directory..."
+    mkdir -p "$PGDATA"
+    cp -a $baked_data/. "$PGDATA"/
+    chmod 700 "$PGDATA"
+    echo "dvdrental data directory seeded."
+fi
@@ -0,0 +1,107 @@
+'''
+    In-memory address directory.
+
+    Loads address, city and country once with a single joined query into a list of
+    records indexed by an array of slots keyed by address_id, so formatting the
+    address of a Customer, Staff or Store is an O(1) lookup instead of the
+    Address -> City -> Country loads. refresh() reloads only the rows whose
+    last_update (of the address, its city or its country) moved past the watermark.
+'''
+import sys
+from array import array
+from datetime import datetime
+from typing import List, NamedTuple, Optional
+from sqlalchemy import select, func
+from sqlalchemy.orm import Session
+from models import Address, City, Country
+
+class AddressRecord(NamedTuple):
+    address_id: int
+    address: str
+    address2: Optional[str]
+    district: str
+    city: str
+    postal_code: Optional[str]
+    country: str
+    phone: str
+
+def format_address(record: AddressRecord) -> str:
+    locality = ' '.join(part for part in (record.district, record.postal_code) if part)
+    return ', '.join(part for part in (record.address, record.address2, record.city, locality, record.country) if part)
+
+class AddressDirectory():
+    def __init__(self):
+        # slot of each address_id in the record lists, -1 for unknown ids
+        self._slots = array('l')
+        self._records: List[AddressRecord] = []
+        self._formatted: List[str] = []
+        self.watermark: Optional[datetime] = None
+
+    @classmethod
+    def load(cls, session: Session) -> 'AddressDirectory':
+        directory = cls()
+        directory.refresh(session)
+        return directory
+
+    def refresh(self, session: Session) -> int:
+        '''
+            Load the addresses changed since the last refresh, all of them on the first
+            call, and return how many were (re)loaded. Deleted addresses, and rows
+            committed late with a last_update older than the watermark, are only picked
+            up by loading a new directory.
+        '''
+        changed = func.greatest(Address.last_update, City.last_update, Country.last_update)
+        stmt = select(
+            Address.address_id, Address.address, Address.address2, Address.district, City.city,
+            Address.postal_code, Country.country, Address.phone, changed.label('changed')
+        ).select_from(Address)\
+        .join(City)\
+        .join(Country)
+        if self.watermark is not None:
+            stmt = stmt.where(changed > self.watermark)
+
+        loaded = 0
+        for row in session.execute(stmt):
+            record = AddressRecord(row.address_id, row.address, row.address2, row.district,
+                                   sys.intern(row.city), row.postal_code, sys.intern(row.country), row.phone)
+            self._store(record)
+            if self.watermark is None or row.changed > self.watermark:
+                self.watermark = row.changed
+            loaded += 1
+        return loaded
+
+    def _store(self, record: AddressRecord) -> None:
+        if record.address_id >= len(self._slots):
+            self._slots.extend([-1] * (record.address_id + 1 - len(self._slots)))
+        slot = self._slots[record.address_id]
+        if slot < 0:
+            self._slots[record.address_id] = len(self._records)
+            self._records.append(record)
+            self._formatted.append(format_address(record))
+        else:
+            self._records[slot] = record
+            self._formatted[slot] = format_address(record)
+
+    def _slot(self, address_id: int) -> int:
+        if 0 <= address_id < len(self._slots):
+            return self._slots[address_id]
+        return -1
+
+    def get(self, address_id: int) -> Optional[AddressRecord]:
+        slot = self._slot(address_id)
+        return self._records[slot] if slot >= 0 else None
+
+    def format(self, address_id: int) -> Optional[str]:
+        '''One line address, e.g. "47 MySakila Drive, Lethbridge, Alberta, Canada"'''
+        slot = self._slot(address_id)
+        return self._formatted[slot] if slot >= 0 else None
+
+    def format_for(self, owner) -> Optional[str]:
+        '''Address of a Customer, Staff or Store, without loading its address relationship'''
+        return self.format(owner.address_id)
+
+    def __contains__(self, address_id: int) -> bool:
+        return self._slot(address_id) >= 0
+
+    def __len__(self) -> int:
+        return len(self._records)
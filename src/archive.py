@@ -0,0 +1,141 @@
+'''
+    Archival of old returned rentals and their payments.
+
+    Rentals returned before the retention window are rarely read again but every
+    index on rental and payment keeps growing with them. archive_returned() moves
+    them, with their payments, to rental_archive and payment_archive in batches, each
+    batch one transaction of
+
+        WITH moved AS (DELETE FROM payment WHERE rental_id IN (...) RETURNING ...)
+        INSERT INTO payment_archive (...) SELECT ... FROM moved
+
+    and the same for rental, so a row is always in exactly one of the two tables. The
+    archived rows keep their ids.
+
+    rentals_between() and payments_between() read a date range from the hot table
+    only, unless the range starts at or before the newest archived date, in which case
+    the archive is added with UNION ALL. The rows are plain column rows, not Rental or
+    Payment objects. The revenue rollups (rollups.py) are not touched by archiving,
+    but rebuild_rollups() only sees the payments left in payment.
+'''
+from datetime import datetime, timedelta
+from typing import NamedTuple, Optional, Tuple
+from sqlalchemy import Column, Index, MetaData, Table, TIMESTAMP, delete, func, insert, select, text, union_all
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.sql import Select
+from models import Payment, Rental
+
+RETENTION = timedelta(days=365)
+BATCH_SIZE = 1000
+# date column of each archive table the range queries and the horizon use
+DATE_COLUMNS = {'rental_archive': 'rental_date', 'payment_archive': 'payment_date'}
+
+metadata = MetaData(schema='public')
+
+def _archive_table(name: str, source: Table, *indexes: str) -> Table:
+    '''Copy of the columns of source, without foreign keys or defaults'''
+    columns = [Column(column.name, column.type, primary_key=column.primary_key, nullable=column.nullable,
+                      autoincrement=False)
+               for column in source.columns]
+    return Table(
+        name,
+        metadata,
+        *columns,
+        Column('archived_at', TIMESTAMP, nullable=False, server_default=text('now()')),
+        *(Index(f'idx_{name}_{column}', column) for column in indexes)
+    )
+
+rental_archive = _archive_table('rental_archive', Rental.__table__, 'rental_date', 'customer_id', 'inventory_id')
+payment_archive = _archive_table('payment_archive', Payment.__table__, 'payment_date', 'customer_id', 'rental_id')
+
+class ArchiveResult(NamedTuple):
+    batches: int
+    rentals: int
+    payments: int
+
+def create_archive(conn: Connection) -> None:
+    metadata.create_all(conn)
+
+def _move(conn: Connection, source: Table, target: Table, where) -> int:
+    names = [column.name for column in source.columns]
+    moved = delete(source).where(where).returning(*source.columns).cte('moved')
+    return conn.execute(insert(target).from_select(names, select(*(moved.c[name] for name in names)))).rowcount
+
+def archive_batch(conn: Connection, cutoff: datetime, batch_size: int = BATCH_SIZE) -> Tuple[int, int]:
+    '''
+        Move up to batch_size rentals returned before cutoff and their payments in the
+        transaction of the connection, return the (rentals, payments) moved.
+    '''
+    rental = Rental.__table__
+    payment = Payment.__table__
+    # a rental returned before the cutoff was also rented before it, which lets the
+    # rental_date index narrow the scan
+    rental_ids = conn.execute(
+        select(rental.c.rental_id)
+        .where(rental.c.rental_date < cutoff, rental.c.return_date < cutoff)
+        .order_by(rental.c.rental_id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    ).scalars().all()
+    if not rental_ids:
+        return 0, 0
+    payments = _move(conn, payment, payment_archive, payment.c.rental_id.in_(rental_ids))
+    rentals = _move(conn, rental, rental_archive, rental.c.rental_id.in_(rental_ids))
+    return rentals, payments
+
+def archive_returned(engine: Engine, retention: timedelta = RETENTION, now: Optional[datetime] = None,
+                     batch_size: int = BATCH_SIZE, max_batches: Optional[int] = None) -> ArchiveResult:
+    '''
+        Archive the rentals returned more than retention ago, committing every batch so
+        locks are held briefly and an interrupted job keeps the batches already moved.
+    '''
+    cutoff = (now or datetime.utcnow()) - retention
+    with engine.begin() as conn:
+        create_archive(conn)
+    batches = rentals = payments = 0
+    while max_batches is None or batches < max_batches:
+        with engine.begin() as conn:
+            moved_rentals, moved_payments = archive_batch(conn, cutoff, batch_size)
+        if not moved_rentals:
+            break
+        batches += 1
+        rentals += moved_rentals
+        payments += moved_payments
+    return ArchiveResult(batches, rentals, payments)
+
+def horizon(conn: Connection, table: Table) -> Optional[datetime]:
+    '''Newest date of the archive table, None when nothing was archived'''
+    if not conn.dialect.has_table(conn, table.name, schema=table.schema):
+        return None
+    return conn.execute(select(func.max(table.c[DATE_COLUMNS[table.name]]))).scalar_one()
+
+def _between(conn: Connection, hot: Table, archived: Table,
+             start: Optional[datetime], end: Optional[datetime], **filters) -> Select:
+    column = DATE_COLUMNS[archived.name]
+
+    def _range(table: Table) -> Select:
+        stmt = select(*(table.c[hot_column.name] for hot_column in hot.columns))
+        if start is not None:
+            stmt = stmt.where(table.c[column] >= start)
+        if end is not None:
+            stmt = stmt.where(table.c[column] < end)
+        for name, value in filters.items():
+            if value is not None:
+                stmt = stmt.where(table.c[name] == value)
+        return stmt
+
+    newest = horizon(conn, archived)
+    if newest is None or (start is not None and start > newest):
+        return _range(hot).order_by(hot.c[column])
+    combined = union_all(_range(hot), _range(archived)).subquery()
+    return select(combined).order_by(combined.c[column])
+
+def rentals_between(conn: Connection, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                    customer_id: Optional[int] = None) -> Select:
+    '''Rentals of [start, end), from rental_archive as well when the range reaches it'''
+    return _between(conn, Rental.__table__, rental_archive, start, end, customer_id=customer_id)
+
+def payments_between(conn: Connection, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                     customer_id: Optional[int] = None) -> Select:
+    '''Payments of [start, end), from payment_archive as well when the range reaches it'''
+    return _between(conn, Payment.__table__, payment_archive, start, end, customer_id=customer_id)
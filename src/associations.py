@@ -0,0 +1,147 @@
+'''
+    Bulk synchronisation of the film association tables (film_actor, film_category
+    and inventory).
+
+    Appending to Film.actors / Film.categories / Film.stores flushes one INSERT per
+    link. The functions in this module take the desired state of the links for a set
+    of films, diff it against the database and apply the difference with multi-row
+    INSERT ... ON CONFLICT DO NOTHING and batched DELETE statements.
+
+    All statements run in the transaction of the given session; the caller decides
+    when to commit.
+'''
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Set, Tuple
+from sqlalchemy import Table, select, delete, exists, func, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from models import film_actor, film_category, inventory, Rental
+
+BATCH_SIZE = 1000
+
+class SyncResult(NamedTuple):
+    inserted: int
+    deleted: int
+    # surplus rows left in place, the sync did not reach the target when not 0
+    kept: int = 0
+
+def _batches(items: Sequence, size: int = BATCH_SIZE) -> Iterator[Sequence]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def _scope(target_films: Set[int], film_ids: Optional[Iterable[int]]) -> List[int]:
+    '''The films to compare, the target may not name films outside of film_ids'''
+    if film_ids is None:
+        return sorted(target_films)
+    scope = set(film_ids)
+    outside = target_films - scope
+    if outside:
+        raise ValueError(f'films outside of film_ids: {", ".join(str(film_id) for film_id in sorted(outside))}')
+    return sorted(scope)
+
+def _sync_pairs(session: Session, table: Table, column: str,
+                desired: Iterable[Tuple[int, int]], film_ids: Optional[Iterable[int]]) -> SyncResult:
+    desired_pairs = {(film_id, other_id) for film_id, other_id in desired}
+    scope = _scope({film_id for film_id, _ in desired_pairs}, film_ids)
+
+    existing: Set[Tuple[int, int]] = set()
+    for batch in _batches(scope):
+        rows = session.execute(
+            select(table.c.film_id, table.c[column]).where(table.c.film_id.in_(batch))
+        )
+        existing.update((row[0], row[1]) for row in rows)
+
+    inserted = 0
+    now = datetime.utcnow()
+    for batch in _batches(sorted(desired_pairs - existing)):
+        stmt = insert(table).values([
+            {'film_id': film_id, column: other_id, 'last_update': now} for film_id, other_id in batch
+        ]).on_conflict_do_nothing()
+        inserted += session.execute(stmt).rowcount
+
+    deleted = 0
+    for batch in _batches(sorted(existing - desired_pairs)):
+        stmt = delete(table).where(tuple_(table.c.film_id, table.c[column]).in_(batch))
+        deleted += session.execute(stmt).rowcount
+
+    return SyncResult(inserted, deleted)
+
+def sync_film_actors(session: Session, pairs: Iterable[Tuple[int, int]],
+                     film_ids: Optional[Iterable[int]] = None) -> SyncResult:
+    '''
+        Make film_actor match the given (film_id, actor_id) pairs.
+
+        Only the films in film_ids are compared, which defaults to the films present
+        in pairs. Pass film_ids explicitly to remove every actor from a film.
+        Raises ValueError when pairs name a film outside of film_ids.
+    '''
+    return _sync_pairs(session, film_actor, 'actor_id', pairs, film_ids)
+
+def sync_film_categories(session: Session, pairs: Iterable[Tuple[int, int]],
+                         film_ids: Optional[Iterable[int]] = None) -> SyncResult:
+    '''Make film_category match the given (film_id, category_id) pairs.'''
+    return _sync_pairs(session, film_category, 'category_id', pairs, film_ids)
+
+def sync_inventory(session: Session, counts: Iterable[Tuple[int, int, int]],
+                   film_ids: Optional[Iterable[int]] = None) -> SyncResult:
+    '''
+        Make the number of inventory copies per (film_id, store_id) match the given
+        (film_id, store_id, count) triples.
+
+        Missing copies are added with multi-row inserts. Surplus copies are removed
+        newest first, but only copies that were never rented: rental history keeps
+        a reference to the inventory row, so those copies are left in place and
+        counted in SyncResult.kept. Like sync_film_actors(), only the films in
+        film_ids are compared and ValueError is raised for counts of other films.
+    '''
+    target: Dict[Tuple[int, int], int] = {}
+    for film_id, store_id, count in counts:
+        target[(film_id, store_id)] = count
+    scope = _scope({film_id for film_id, _ in target}, film_ids)
+
+    current: Dict[Tuple[int, int], int] = {}
+    for batch in _batches(scope):
+        rows = session.execute(
+            select(inventory.c.film_id, inventory.c.store_id, func.count())
+            .where(inventory.c.film_id.in_(batch))
+            .group_by(inventory.c.film_id, inventory.c.store_id)
+        )
+        current.update(((row[0], row[1]), row[2]) for row in rows)
+
+    now = datetime.utcnow()
+    new_copies: List[dict] = []
+    surplus: Dict[Tuple[int, int], int] = {}
+    for key in set(target) | set(current):
+        difference = target.get(key, 0) - current.get(key, 0)
+        if difference > 0:
+            new_copies.extend({'film_id': key[0], 'store_id': key[1], 'last_update': now} for _ in range(difference))
+        elif difference < 0:
+            surplus[key] = -difference
+
+    inserted = 0
+    for batch in _batches(new_copies):
+        inserted += session.execute(insert(inventory).values(list(batch))).rowcount
+
+    removable: List[int] = []
+    if surplus:
+        surplus_films = sorted({film_id for film_id, _ in surplus})
+        taken: Dict[Tuple[int, int], int] = defaultdict(int)
+        for batch in _batches(surplus_films):
+            rows = session.execute(
+                select(inventory.c.inventory_id, inventory.c.film_id, inventory.c.store_id)
+                .where(inventory.c.film_id.in_(batch))
+                .where(~exists().where(Rental.inventory_id == inventory.c.inventory_id))
+                .order_by(inventory.c.inventory_id.desc())
+            )
+            for inventory_id, film_id, store_id in rows:
+                key = (film_id, store_id)
+                if taken[key] < surplus.get(key, 0):
+                    taken[key] += 1
+                    removable.append(inventory_id)
+
+    deleted = 0
+    for batch in _batches(removable):
+        deleted += session.execute(delete(inventory).where(inventory.c.inventory_id.in_(batch))).rowcount
+
+    return SyncResult(inserted, deleted, sum(surplus.values()) - len(removable))
@@ -0,0 +1,131 @@
+'''
+    Chunked batch processing with a bounded identity map.
+
+    A job walking every Rental or Payment through one session keeps every loaded
+    object, and everything joined to it, in the identity map until the session ends.
+    process_in_chunks() splits the rows of a statement into ranges of its key column
+    computed up front with one keyset query, loads and processes each range in its own
+    session, commits it and closes the session, so memory stays at one chunk per
+    worker. Chunks can run on a thread pool, each worker using its own sessions, and a
+    JSON checkpoint file records the chunks already committed so a failed job resumes
+    with the remaining ones.
+
+        def recalculate_fees(session, rentals):
+            ...
+        process_in_chunks(Session, select(Rental), Rental.rental_id, recalculate_fees,
+                          chunk_size=5000, workers=4, checkpoint='fees.json')
+'''
+import json
+import os
+import threading
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from typing import Any, Callable, List, NamedTuple, Optional, Set, Tuple
+from sqlalchemy import Column, func, select
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.sql import Select
+
+CHUNK_SIZE = 1000
+
+Bounds = Tuple[Any, Optional[Any]]
+Work = Callable[[Session, List[Any]], None]
+
+class BatchResult(NamedTuple):
+    chunks: int
+    # chunks committed by this run and rows they held
+    processed: int
+    rows: int
+    # chunks committed by a previous run according to the checkpoint
+    skipped: int
+
+def chunk_bounds(session: Session, stmt: Select, key: Column, chunk_size: int = CHUNK_SIZE) -> List[Bounds]:
+    '''
+        [lower, upper) key ranges holding chunk_size rows of the statement each, the upper
+        bound of the last range is None so rows added with higher keys are included.
+        The statement FROM and WHERE clauses are applied, its columns and options are not.
+    '''
+    keys = select(key.label('key'), func.row_number().over(order_by=key).label('position'))\
+            .select_from(*stmt.get_final_froms())
+    if stmt.whereclause is not None:
+        keys = keys.where(stmt.whereclause)
+    keys = keys.subquery()
+    starts = session.execute(
+        select(keys.c.key).where((keys.c.position - 1) % chunk_size == 0).order_by(keys.c.key)
+    ).scalars().all()
+    return list(zip(starts, starts[1:] + [None]))
+
+class _Checkpoint():
+    '''Bounds of the job and indexes of the committed chunks, rewritten atomically after every chunk'''
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.bounds: Optional[List[Bounds]] = None
+        self.done: Set[int] = set()
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as source:
+                document = json.load(source)
+            self.bounds = [tuple(bounds) for bounds in document['bounds']]
+            self.done = set(document['done'])
+
+    def completed(self, index: int) -> None:
+        with self._lock:
+            self.done.add(index)
+            if self.path:
+                temporary = f'{self.path}.tmp'
+                with open(temporary, 'w', encoding='utf-8') as output:
+                    json.dump({'bounds': self.bounds, 'done': sorted(self.done)}, output)
+                os.replace(temporary, self.path)
+
+    def remove(self) -> None:
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+def process_chunk(session_factory: sessionmaker, stmt: Select, key: Column, bounds: Bounds, work: Work) -> int:
+    '''Load the rows of one key range in a new session, pass them to work and commit'''
+    lower, upper = bounds
+    chunk = stmt.where(key >= lower)
+    if upper is not None:
+        chunk = chunk.where(key < upper)
+    with session_factory() as session:
+        rows = session.execute(chunk.order_by(None).order_by(key)).unique().scalars().all()
+        work(session, rows)
+        session.commit()
+        return len(rows)
+
+def process_in_chunks(session_factory: sessionmaker, stmt: Select, key: Column, work: Work,
+                      chunk_size: int = CHUNK_SIZE, workers: int = 1, checkpoint: Optional[str] = None) -> BatchResult:
+    '''
+        Run work(session, rows) for every chunk of the statement rows in key order and
+        commit each chunk. With a checkpoint path the chunk bounds and the committed
+        chunks are saved, a run finding the file only processes the chunks missing from
+        it and the file is removed once every chunk is committed. Keys must be JSON
+        serializable, e.g. integer primary keys. The first chunk failing stops the job
+        and its error is raised.
+    '''
+    state = _Checkpoint(checkpoint)
+    if state.bounds is None:
+        with session_factory() as session:
+            state.bounds = chunk_bounds(session, stmt, key, chunk_size)
+    pending = [index for index in range(len(state.bounds)) if index not in state.done]
+    skipped = len(state.bounds) - len(pending)
+
+    def _run(index: int) -> int:
+        rows = process_chunk(session_factory, stmt, key, state.bounds[index], work)
+        state.completed(index)
+        return rows
+
+    rows = 0
+    if workers <= 1:
+        for index in pending:
+            rows += _run(index)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_run, index) for index in pending]
+            done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+            for future in not_done:
+                future.cancel()
+            for future in done:
+                if future.exception() is not None:
+                    raise future.exception()
+            rows = sum(future.result() for future in futures)
+    state.remove()
+    return BatchResult(len(state.bounds), len(pending), rows, skipped)
@@ -0,0 +1,74 @@
+'''
+    Chunked access to Staff.picture.
+
+    bytea values cannot be streamed by the driver. The picture is written chunk by
+    chunk into a temporary large object with lo_put(), which appends without rewriting
+    what was written before, then copied into staff.picture with one UPDATE and the
+    large object removed, so the value is stored once. It is read with substring()
+    over fixed size byte ranges. substring() of a compressed value decompresses it from
+    the start every time, use_external_storage() stores pictures uncompressed so each
+    range only reads its own TOAST chunks. Neither side ever holds more than one chunk
+    of the picture in memory.
+'''
+from typing import BinaryIO, Iterator, Optional
+from sqlalchemy import LargeBinary, func, select, update, literal, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.util import identity_key
+from models import Staff
+
+CHUNK_SIZE = 64 * 1024
+
+def use_external_storage(conn: Connection) -> None:
+    '''Store the pictures written from now on out of line and uncompressed'''
+    conn.execute(text('ALTER TABLE public.staff ALTER COLUMN picture SET STORAGE EXTERNAL'))
+
+def picture_size(session: Session, staff_id: int) -> Optional[int]:
+    '''Size of the picture in bytes, None when the staff has no picture'''
+    stmt = select(func.octet_length(Staff.picture)).where(Staff.staff_id == staff_id)
+    return session.execute(stmt).scalar_one_or_none()
+
+def iter_picture(session: Session, staff_id: int, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    size = picture_size(session, staff_id)
+    if size is None:
+        return
+    for offset in range(0, size, chunk_size):
+        # substring() positions are 1-based
+        stmt = select(func.substring(Staff.picture, offset + 1, chunk_size, type_=LargeBinary))\
+                .where(Staff.staff_id == staff_id)
+        yield bytes(session.execute(stmt).scalar_one())
+
+def read_picture(session: Session, staff_id: int, fileobj: BinaryIO, chunk_size: int = CHUNK_SIZE) -> int:
+    '''Copy the picture into a binary file object, returns the number of bytes written'''
+    written = 0
+    for chunk in iter_picture(session, staff_id, chunk_size):
+        fileobj.write(chunk)
+        written += len(chunk)
+    return written
+
+def write_picture(session: Session, staff_id: int, fileobj: BinaryIO, chunk_size: int = CHUNK_SIZE) -> int:
+    '''
+        Replace the picture with the content of a binary file object, returns the number
+        of bytes stored. An empty file removes the picture. The statements run in the
+        session transaction, the caller commits.
+    '''
+    table = Staff.__table__
+    written = 0
+    first = fileobj.read(chunk_size)
+    if not first:
+        session.execute(update(table).where(table.c.staff_id == staff_id).values(picture=None))
+    else:
+        oid = session.execute(select(func.lo_from_bytea(0, literal(first, LargeBinary)))).scalar_one()
+        written = len(first)
+        for chunk in iter(lambda: fileobj.read(chunk_size), b''):
+            session.execute(select(func.lo_put(oid, written, literal(chunk, LargeBinary))))
+            written += len(chunk)
+        session.execute(update(table).where(table.c.staff_id == staff_id)
+                        .values(picture=func.lo_get(oid, type_=LargeBinary)))
+        session.execute(select(func.lo_unlink(oid)))
+
+    # a Staff already loaded in the session would otherwise keep the old picture
+    staff = session.identity_map.get(identity_key(Staff, staff_id))
+    if staff is not None:
+        session.expire(staff, ['picture'])
+    return written
@@ -0,0 +1,133 @@
+'''
+    Compiled statement cache metrics per engine.
+
+    SQLAlchemy caches the compiled form of a statement under its cache key in
+    engine._compiled_cache, an LRU cache of query_cache_size entries. Every execution
+    reports whether the compiled form came from that cache in context.cache_hit, which
+    CompiledCacheMonitor counts in an after_cursor_execute listener together with the
+    SQL of the statements that missed. A statement missing over and over with the
+    same SQL means its cache key changes on every call (values embedded in the
+    statement instead of bound, statements built from per-call lambdas, ...) or the
+    cache is too small and keeps evicting it.
+
+        monitor = CompiledCacheMonitor(engine)
+        ...
+        print(format_metrics(monitor.snapshot()))
+        for sql, misses in monitor.missed_statements(5):
+            print(misses, sql)
+'''
+import threading
+from collections import Counter
+from typing import List, NamedTuple, Tuple
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.interfaces import CacheStats
+
+# distinct SQL strings remembered for missed_statements() / uncached_statements()
+MAX_TRACKED_STATEMENTS = 1000
+
+class CompiledCacheSnapshot(NamedTuple):
+    hits: int
+    misses: int
+    # plain SQL strings run with exec_driver_sql() and statements with an element that cannot be cached
+    uncached: int
+    # engines created with query_cache_size=0 and dialects without cache support
+    disabled: int
+    size: int
+    capacity: int
+    evictions: int
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+class CompiledCacheMonitor():
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self._lock = threading.Lock()
+        self._counts: Counter = Counter()
+        self._missed: Counter = Counter()
+        self._uncached: Counter = Counter()
+        self._evictions = 0
+        self._cache = engine._compiled_cache
+        self._size_alert = None
+        if self._cache is not None:
+            # the cache calls size_alert once before every pruning pass
+            self._size_alert = self._cache.size_alert
+            self._cache.size_alert = self._pruning
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    def _pruning(self, cache) -> None:
+        with self._lock:
+            self._evictions += max(len(cache) - cache.capacity, 0)
+        if self._size_alert is not None:
+            self._size_alert(cache)
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        status = context.cache_hit
+        with self._lock:
+            self._counts[status] += 1
+            if status is CacheStats.CACHE_MISS:
+                self._track(self._missed, statement)
+            elif status is CacheStats.NO_CACHE_KEY:
+                self._track(self._uncached, statement)
+
+    @staticmethod
+    def _track(counter: Counter, statement: str) -> None:
+        if statement in counter or len(counter) < MAX_TRACKED_STATEMENTS:
+            counter[statement] += 1
+
+    def snapshot(self) -> CompiledCacheSnapshot:
+        with self._lock:
+            return CompiledCacheSnapshot(
+                hits=self._counts[CacheStats.CACHE_HIT],
+                misses=self._counts[CacheStats.CACHE_MISS],
+                uncached=self._counts[CacheStats.NO_CACHE_KEY],
+                disabled=self._counts[CacheStats.CACHING_DISABLED] + self._counts[CacheStats.NO_DIALECT_SUPPORT],
+                size=len(self._cache) if self._cache is not None else 0,
+                capacity=self._cache.capacity if self._cache is not None else 0,
+                evictions=self._evictions,
+            )
+
+    def missed_statements(self, limit: int = 10) -> List[Tuple[str, int]]:
+        '''(SQL, misses) of the statements compiled most often, a count above 1 is a wasted compile'''
+        with self._lock:
+            return self._missed.most_common(limit)
+
+    def uncached_statements(self, limit: int = 10) -> List[Tuple[str, int]]:
+        '''(SQL, executions) of the statements that could not be cached at all'''
+        with self._lock:
+            return self._uncached.most_common(limit)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counts.clear()
+            self._missed.clear()
+            self._uncached.clear()
+            self._evictions = 0
+
+    def close(self) -> None:
+        '''Stop counting and give the cache its own size alert back'''
+        event.remove(self.engine, 'after_cursor_execute', self._after_cursor_execute)
+        if self._cache is not None:
+            self._cache.size_alert = self._size_alert
+
+def format_metrics(snapshot: CompiledCacheSnapshot, engine_name: str = 'default') -> str:
+    '''The snapshot in the Prometheus text exposition format'''
+    label = f'{{engine="{engine_name}"}}'
+    metrics = [
+        ('sqlalchemy_compiled_cache_hits_total', 'counter', snapshot.hits),
+        ('sqlalchemy_compiled_cache_misses_total', 'counter', snapshot.misses),
+        ('sqlalchemy_compiled_cache_uncached_total', 'counter', snapshot.uncached),
+        ('sqlalchemy_compiled_cache_disabled_total', 'counter', snapshot.disabled),
+        ('sqlalchemy_compiled_cache_evictions_total', 'counter', snapshot.evictions),
+        ('sqlalchemy_compiled_cache_size', 'gauge', snapshot.size),
+        ('sqlalchemy_compiled_cache_capacity', 'gauge', snapshot.capacity),
+        ('sqlalchemy_compiled_cache_hit_ratio', 'gauge', round(snapshot.hit_ratio, 6)),
+    ]
+    lines = []
+    for name, kind, value in metrics:
+        lines.append(f'# TYPE {name} {kind}')
+        lines.append(f'{name}{label} {value}')
+    return '\n'.join(lines) + '\n'
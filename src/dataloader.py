@@ -0,0 +1,237 @@
+'''
+    DataLoader style batching of relationship loads.
+
+    Resolving nested fields object by object (rental -> film -> categories, customer ->
+    address -> city) lazy loads every relationship of every object with its own query.
+    A RelationshipLoader collects the objects whose relationship is requested, then
+    loads the related objects of all of them with one IN (...) query and sets them on
+    the objects as if they had been loaded, so later attribute access does not query.
+    Results are memoized by key for the life of the loader, and RequestLoaders holds
+    one loader per relationship for the scope of a request:
+
+        loaders = RequestLoaders(session)
+        pending = [loaders.loader(Rental.film).load(rental) for rental in rentals]
+        films = [film.result() for film in pending]        # one query
+        loaders.load_path(rentals, Rental.film, Film.categories)
+
+    AsyncRelationshipLoader does the same for asyncio code: loads awaited in the same
+    event loop tick are batched into one query run through an AsyncSession.
+'''
+import asyncio
+from collections import defaultdict
+from typing import Any, Dict, Hashable, Iterable, List, Sequence, Tuple
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import InstrumentedAttribute, set_committed_value
+
+# keys per IN (...) query
+BATCH_SIZE = 1000
+
+_MISSING = object()
+
+class _Relationship():
+    '''Query building for a relationship joined on a single column'''
+    def __init__(self, attribute: InstrumentedAttribute):
+        self.property = attribute.property
+        self.key = self.property.key
+        self.uselist = self.property.uselist
+        self.target = self.property.mapper
+        parent = self.property.parent
+        # with a secondary table the pairs of the secondary join come after the parent ones
+        pairs = [(local, remote) for local, remote in self.property.local_remote_pairs
+                 if parent.persist_selectable.c.contains_column(local)]
+        if len(pairs) != 1:
+            raise ValueError(f'{parent.class_.__name__}.{self.key} does not join on a single column')
+        local, remote = pairs[0]
+        self.local = parent.get_property_by_column(local).key
+        self.remote = remote
+        if self.property.secondary is None:
+            self.remote_key = self.target.get_property_by_column(remote).key
+            # many-to-one to the primary key, objects in the identity map need no query
+            self.by_identity = list(self.target.primary_key) == [remote]
+
+    def key_of(self, instance: Any) -> Hashable:
+        return getattr(instance, self.local)
+
+    def from_identity_map(self, session: Session, key: Hashable) -> Any:
+        if self.property.secondary is not None or not self.by_identity:
+            return _MISSING
+        return session.identity_map.get(self.target.identity_key_from_primary_key([key]), _MISSING)
+
+    def fetch(self, session: Session, keys: Sequence[Hashable]) -> Dict[Hashable, Any]:
+        '''Related objects of every key, a list or an object or None'''
+        found: Dict[Hashable, List[Any]] = defaultdict(list)
+        for start in range(0, len(keys), BATCH_SIZE):
+            batch = keys[start:start + BATCH_SIZE]
+            if self.property.secondary is not None:
+                rows = session.execute(
+                    select(self.remote, self.target)
+                    .join_from(self.target, self.property.secondary, self.property.secondaryjoin)
+                    .where(self.remote.in_(batch))
+                ).all()
+            else:
+                rows = [(getattr(related, self.remote_key), related) for related in session.execute(
+                    select(self.target).where(self.remote.in_(batch))
+                ).scalars()]
+            for key, related in rows:
+                # a secondary table may link the same objects more than once, e.g. Film.stores
+                if not any(related is known for known in found[key]):
+                    found[key].append(related)
+        if self.uselist:
+            return {key: found.get(key, []) for key in keys}
+        return {key: found[key][0] if found.get(key) else None for key in keys}
+
+    def assign(self, instance: Any, value: Any) -> None:
+        '''Set the loaded value without marking the instance modified'''
+        set_committed_value(instance, self.key, list(value) if self.uselist else value)
+
+class Pending():
+    def __init__(self, loader: 'RelationshipLoader', key: Hashable):
+        self._loader = loader
+        self.key = key
+
+    def result(self) -> Any:
+        '''The related value, dispatching the pending keys of the loader first'''
+        return self._loader.value(self.key)
+
+class RelationshipLoader():
+    def __init__(self, session: Session, attribute: InstrumentedAttribute):
+        self.session = session
+        self.relationship = _Relationship(attribute)
+        self.memo: Dict[Hashable, Any] = {}
+        self.queries = 0
+        self._pending: Dict[Hashable, List[Any]] = defaultdict(list)
+
+    def load(self, instance: Any) -> Pending:
+        '''Queue the relationship of the instance, resolved by dispatch() or Pending.result()'''
+        key = self.relationship.key_of(instance)
+        if key in self.memo:
+            self.relationship.assign(instance, self.memo[key])
+        else:
+            self._pending[key].append(instance)
+        return Pending(self, key)
+
+    def load_many(self, instances: Iterable[Any]) -> List[Any]:
+        pending = [self.load(instance) for instance in instances]
+        self.dispatch()
+        return [item.result() for item in pending]
+
+    def dispatch(self) -> None:
+        '''Resolve the queued keys, with at most one query for the keys not in the identity map'''
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, defaultdict(list)
+        missing = []
+        for key in pending:
+            if key is None:
+                self.memo[key] = [] if self.relationship.uselist else None
+                continue
+            known = self.relationship.from_identity_map(self.session, key)
+            if known is _MISSING:
+                missing.append(key)
+            else:
+                self.memo[key] = known
+        if missing:
+            self.memo.update(self.relationship.fetch(self.session, missing))
+            self.queries += 1
+        for key, instances in pending.items():
+            for instance in instances:
+                self.relationship.assign(instance, self.memo[key])
+
+    def value(self, key: Hashable) -> Any:
+        if key not in self.memo:
+            self.dispatch()
+        return self.memo[key]
+
+class RequestLoaders():
+    '''One memoizing loader per relationship, create one per request and drop it afterwards'''
+    def __init__(self, session: Session):
+        self.session = session
+        self._loaders: Dict[InstrumentedAttribute, RelationshipLoader] = {}
+
+    def loader(self, attribute: InstrumentedAttribute) -> RelationshipLoader:
+        if attribute not in self._loaders:
+            self._loaders[attribute] = RelationshipLoader(self.session, attribute)
+        return self._loaders[attribute]
+
+    def load_path(self, instances: Iterable[Any], *path: InstrumentedAttribute) -> List[Any]:
+        '''
+            Load a chain of relationships level by level, one query per level at most,
+            e.g. load_path(customers, Customer.address, Address.city). Returns the
+            distinct objects of the last level.
+        '''
+        level = list(instances)
+        for attribute in path:
+            values = self.loader(attribute).load_many(level)
+            level = _distinct(related for value in values
+                              for related in (value if isinstance(value, list) else [value])
+                              if related is not None)
+        return level
+
+    @property
+    def queries(self) -> int:
+        return sum(loader.queries for loader in self._loaders.values())
+
+def _distinct(items: Iterable[Any]) -> List[Any]:
+    seen = set()
+    return [item for item in items if id(item) not in seen and not seen.add(id(item))]
+
+class AsyncRelationshipLoader():
+    '''
+        Loads awaited during one event loop tick are resolved together with one query run
+        on the AsyncSession (sqlalchemy.ext.asyncio, with an async driver such as asyncpg).
+    '''
+    def __init__(self, session, attribute: InstrumentedAttribute):
+        self.session = session
+        self.relationship = _Relationship(attribute)
+        self.memo: Dict[Hashable, Any] = {}
+        self.queries = 0
+        self._pending: Dict[Hashable, Tuple[asyncio.Future, List[Any]]] = {}
+        self._scheduled = False
+
+    async def load(self, instance: Any) -> Any:
+        key = self.relationship.key_of(instance)
+        if key in self.memo:
+            self.relationship.assign(instance, self.memo[key])
+            return self.memo[key]
+        if key not in self._pending:
+            self._pending[key] = (asyncio.get_running_loop().create_future(), [])
+        future, instances = self._pending[key]
+        instances.append(instance)
+        if not self._scheduled:
+            self._scheduled = True
+            asyncio.get_running_loop().call_soon(lambda: asyncio.ensure_future(self._dispatch()))
+        return await future
+
+    async def load_many(self, instances: Iterable[Any]) -> List[Any]:
+        return list(await asyncio.gather(*(self.load(instance) for instance in instances)))
+
+    async def _dispatch(self) -> None:
+        pending, self._pending, self._scheduled = self._pending, {}, False
+        keys = [key for key in pending if key is not None]
+        try:
+            found = await self.session.run_sync(lambda session: self._fetch(session, keys)) if keys else {}
+        except Exception as error:  # pylint: disable=broad-except
+            for future, _ in pending.values():
+                future.set_exception(error)
+            return
+        for key, (future, instances) in pending.items():
+            value = found.get(key, [] if self.relationship.uselist else None)
+            self.memo[key] = value
+            for instance in instances:
+                self.relationship.assign(instance, value)
+            future.set_result(value)
+
+    def _fetch(self, session: Session, keys: List[Hashable]) -> Dict[Hashable, Any]:
+        found: Dict[Hashable, Any] = {}
+        missing = []
+        for key in keys:
+            known = self.relationship.from_identity_map(session, key)
+            if known is _MISSING:
+                missing.append(key)
+            else:
+                found[key] = known
+        if missing:
+            found.update(self.relationship.fetch(session, missing))
+            self.queries += 1
+        return found
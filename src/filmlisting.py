@@ -0,0 +1,150 @@
+'''
+    Denormalized film listing.
+
+    The catalog reads the film_list report on every page load, which joins film,
+    category and actor and aggregates the cast of every film. install_film_listing()
+    stores that result in a film_listing table, one row per film and category with the
+    same columns as the report, and creates triggers on film, film_actor, film_category,
+    actor and category that rebuild the rows of the films a write touched, so reading
+    the catalog is a plain indexed select. The association tables are written in bulk
+    (see associations.py), their triggers run once per statement and refresh every
+    film of the statement's transition table in one call:
+
+        with engine.begin() as conn:
+            install_film_listing(conn)
+        rows = conn.execute(film_listing_query(category='Action')).all()
+
+    The row refresh function is compiled from reports.film_list(), so the table holds
+    exactly what the report returns.
+'''
+from typing import Iterable, Optional
+from sqlalchemy import Column, Index, Integer, MetaData, Numeric, SmallInteger, String, Table, Text, func, literal_column, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql import Select
+from models import Film
+from reports import film_list
+
+metadata = MetaData(schema='public')
+
+film_listing = Table(
+    'film_listing',
+    metadata,
+    Column('fid', Integer, primary_key=True),
+    Column('title', String(255), nullable=False),
+    Column('description', Text),
+    Column('category', String(25), primary_key=True),
+    Column('price', Numeric(4, 2), nullable=False),
+    Column('length', SmallInteger),
+    Column('rating', String(10)),
+    Column('actors', Text),
+    Index('idx_film_listing_category', 'category'),
+)
+
+# only the columns shown in the listing refresh it, transition tables cannot be combined with
+# column lists so these stay row triggers
+TRIGGER_EVENTS = {
+    'film': 'INSERT OR DELETE OR UPDATE OF title, description, rental_rate, length, rating',
+    'actor': 'UPDATE OF first_name, last_name',
+    'category': 'UPDATE OF name',
+}
+# statement triggers, one per event since a transition table trigger has a single event
+STATEMENT_TRIGGER_TABLES = ('film_actor', 'film_category')
+TRANSITION_TABLES = {
+    'INSERT': 'NEW TABLE AS new_rows',
+    'DELETE': 'OLD TABLE AS old_rows',
+    'UPDATE': 'OLD TABLE AS old_rows NEW TABLE AS new_rows',
+}
+
+def _refresh_sql() -> str:
+    stmt = film_list().where(Film.film_id == func.any(literal_column('film_ids'))).order_by(None)
+    return str(stmt.compile(dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True}))
+
+def install_film_listing(conn: Connection) -> int:
+    '''Create and fill film_listing and the triggers keeping it current, return the number of rows'''
+    metadata.create_all(conn)
+    columns = ', '.join(column.name for column in film_listing.columns)
+    conn.execute(text(f'''
+        CREATE OR REPLACE FUNCTION public.refresh_film_listing(film_ids integer[]) RETURNS void LANGUAGE sql AS $$
+            DELETE FROM public.film_listing WHERE fid = ANY(film_ids);
+            INSERT INTO public.film_listing ({columns}) {_refresh_sql()};
+        $$'''))
+    conn.execute(text('''
+        CREATE OR REPLACE FUNCTION public.film_listing_sync_statement() RETURNS trigger LANGUAGE plpgsql AS $$
+        DECLARE
+            film_ids integer[];
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                film_ids := ARRAY(SELECT DISTINCT film_id FROM new_rows);
+            ELSIF TG_OP = 'DELETE' THEN
+                film_ids := ARRAY(SELECT DISTINCT film_id FROM old_rows);
+            ELSE
+                film_ids := ARRAY(SELECT film_id FROM old_rows UNION SELECT film_id FROM new_rows);
+            END IF;
+            IF cardinality(film_ids) > 0 THEN
+                PERFORM public.refresh_film_listing(film_ids);
+            END IF;
+            RETURN NULL;
+        END
+        $$'''))
+    conn.execute(text('''
+        CREATE OR REPLACE FUNCTION public.film_listing_sync() RETURNS trigger LANGUAGE plpgsql AS $$
+        DECLARE
+            film_ids integer[];
+        BEGIN
+            IF TG_TABLE_NAME = 'actor' THEN
+                film_ids := ARRAY(SELECT film_id FROM public.film_actor WHERE actor_id = NEW.actor_id);
+            ELSIF TG_TABLE_NAME = 'category' THEN
+                film_ids := ARRAY(SELECT film_id FROM public.film_category WHERE category_id = NEW.category_id);
+            ELSIF TG_OP = 'INSERT' THEN
+                film_ids := ARRAY[NEW.film_id];
+            ELSIF TG_OP = 'DELETE' THEN
+                film_ids := ARRAY[OLD.film_id];
+            ELSE
+                film_ids := ARRAY[OLD.film_id, NEW.film_id];
+            END IF;
+            PERFORM public.refresh_film_listing(film_ids);
+            RETURN NULL;
+        END
+        $$'''))
+    for table, events in TRIGGER_EVENTS.items():
+        conn.execute(text(f'DROP TRIGGER IF EXISTS film_listing_sync ON public.{table}'))
+        conn.execute(text(
+            f'CREATE TRIGGER film_listing_sync AFTER {events} ON public.{table} '
+            'FOR EACH ROW EXECUTE PROCEDURE public.film_listing_sync()'
+        ))
+    for table in STATEMENT_TRIGGER_TABLES:
+        for event, transition in TRANSITION_TABLES.items():
+            conn.execute(text(f'DROP TRIGGER IF EXISTS film_listing_sync_{event.lower()} ON public.{table}'))
+            conn.execute(text(
+                f'CREATE TRIGGER film_listing_sync_{event.lower()} AFTER {event} ON public.{table} '
+                f'REFERENCING {transition} FOR EACH STATEMENT EXECUTE PROCEDURE public.film_listing_sync_statement()'
+            ))
+    return rebuild_film_listing(conn)
+
+def rebuild_film_listing(conn: Connection) -> int:
+    conn.execute(film_listing.delete())
+    columns = [column.name for column in film_listing.columns]
+    return conn.execute(film_listing.insert().from_select(columns, film_list().order_by(None))).rowcount
+
+def refresh_films(conn: Connection, film_ids: Iterable[int]) -> None:
+    '''Rebuild the rows of the films, e.g. after writes made with the triggers disabled'''
+    conn.execute(text('SELECT public.refresh_film_listing(:film_ids)'), {'film_ids': list(film_ids)})
+
+def drop_film_listing(conn: Connection) -> None:
+    for table in TRIGGER_EVENTS:
+        conn.execute(text(f'DROP TRIGGER IF EXISTS film_listing_sync ON public.{table}'))
+    for table in STATEMENT_TRIGGER_TABLES:
+        for event in TRANSITION_TABLES:
+            conn.execute(text(f'DROP TRIGGER IF EXISTS film_listing_sync_{event.lower()} ON public.{table}'))
+    conn.execute(text('DROP FUNCTION IF EXISTS public.film_listing_sync()'))
+    conn.execute(text('DROP FUNCTION IF EXISTS public.film_listing_sync_statement()'))
+    conn.execute(text('DROP FUNCTION IF EXISTS public.refresh_film_listing(integer[])'))
+    metadata.drop_all(conn)
+
+def film_listing_query(category: Optional[str] = None) -> Select:
+    '''The catalog rows in film order, the film_list report read from film_listing'''
+    stmt = film_listing.select().order_by(film_listing.c.fid, film_listing.c.category)
+    if category is not None:
+        stmt = stmt.where(film_listing.c.category == category)
+    return stmt
@@ -0,0 +1,157 @@
+'''
+    In-memory bipartite actor / film graph built from film_actor.
+
+    Actor and film ids are mapped to dense indexes and the edges are kept twice in
+    CSR form (compressed sparse rows): an offsets array per side and a flat array of
+    neighbour indexes sorted within each row. Filmography and cast lookups are array
+    slices, shared film counts are a merge of two sorted rows and degrees of
+    separation is a breadth first search over the two adjacency arrays, none of
+    which touch the database.
+'''
+from array import array
+from collections import Counter, deque
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from models import film_actor
+
+def _csr(size: int, edges: List[Tuple[int, int]]) -> Tuple[array, array]:
+    '''Offsets and targets of the edges (source index, target index) grouped by source'''
+    offsets = array('l', [0] * (size + 1))
+    for source, _ in edges:
+        offsets[source + 1] += 1
+    for index in range(size):
+        offsets[index + 1] += offsets[index]
+    targets = array('l', (target for _, target in sorted(edges)))
+    return offsets, targets
+
+class FilmActorGraph():
+    def __init__(self, pairs: Iterable[Tuple[int, int]] = ()):
+        '''pairs are (film_id, actor_id) edges'''
+        self._pairs: Set[Tuple[int, int]] = set(pairs)
+        self.watermark: Optional[datetime] = None
+        self._build()
+
+    @classmethod
+    def load(cls, session: Session) -> 'FilmActorGraph':
+        graph = cls()
+        graph.refresh(session)
+        return graph
+
+    def refresh(self, session: Session) -> int:
+        '''
+            Add the film_actor rows updated since the last refresh, every row on the first
+            call, and return how many were read. Removed links are not visible here, pass
+            them to apply() or load a new graph.
+        '''
+        stmt = select(film_actor.c.film_id, film_actor.c.actor_id, film_actor.c.last_update)
+        if self.watermark is not None:
+            stmt = stmt.where(film_actor.c.last_update > self.watermark)
+        added = []
+        for film_id, actor_id, last_update in session.execute(stmt):
+            added.append((film_id, actor_id))
+            if self.watermark is None or last_update > self.watermark:
+                self.watermark = last_update
+        self.apply(added=added)
+        return len(added)
+
+    def apply(self, added: Iterable[Tuple[int, int]] = (), removed: Iterable[Tuple[int, int]] = ()) -> None:
+        '''Add and remove (film_id, actor_id) edges, the arrays are rebuilt only when the edges changed'''
+        added, removed = set(added) - self._pairs, set(removed) & self._pairs
+        if added or removed:
+            self._pairs = (self._pairs | added) - removed
+            self._build()
+
+    def _build(self) -> None:
+        self._actor_ids = array('l', sorted({actor_id for _, actor_id in self._pairs}))
+        self._film_ids = array('l', sorted({film_id for film_id, _ in self._pairs}))
+        self._actor_index: Dict[int, int] = {actor_id: index for index, actor_id in enumerate(self._actor_ids)}
+        self._film_index: Dict[int, int] = {film_id: index for index, film_id in enumerate(self._film_ids)}
+        edges = [(self._actor_index[actor_id], self._film_index[film_id]) for film_id, actor_id in self._pairs]
+        self._actor_offsets, self._actor_films = _csr(len(self._actor_ids), edges)
+        self._film_offsets, self._film_actors = _csr(len(self._film_ids), [(film, actor) for actor, film in edges])
+
+    def _films_of(self, actor: int) -> array:
+        return self._actor_films[self._actor_offsets[actor]:self._actor_offsets[actor + 1]]
+
+    def _actors_of(self, film: int) -> array:
+        return self._film_actors[self._film_offsets[film]:self._film_offsets[film + 1]]
+
+    def filmography(self, actor_id: int) -> List[int]:
+        '''Film ids of the actor in ascending order'''
+        actor = self._actor_index.get(actor_id)
+        if actor is None:
+            return []
+        return [self._film_ids[film] for film in self._films_of(actor)]
+
+    def cast(self, film_id: int) -> List[int]:
+        '''Actor ids of the film in ascending order'''
+        film = self._film_index.get(film_id)
+        if film is None:
+            return []
+        return [self._actor_ids[actor] for actor in self._actors_of(film)]
+
+    def co_stars(self, actor_id: int, limit: Optional[int] = None) -> List[Tuple[int, int]]:
+        '''(actor_id, shared film count) of everyone who played with the actor, most shared films first'''
+        actor = self._actor_index.get(actor_id)
+        if actor is None:
+            return []
+        counts: Counter = Counter()
+        for film in self._films_of(actor):
+            counts.update(self._actors_of(film))
+        del counts[actor]
+        ranked = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+        return [(self._actor_ids[other], count) for other, count in ranked[:limit]]
+
+    def shared_film_count(self, actor_id: int, other_actor_id: int) -> int:
+        actor, other = self._actor_index.get(actor_id), self._actor_index.get(other_actor_id)
+        if actor is None or other is None:
+            return 0
+        # both rows are sorted, count the common film indexes with a merge
+        films, other_films = self._films_of(actor), self._films_of(other)
+        i = j = shared = 0
+        while i < len(films) and j < len(other_films):
+            if films[i] == other_films[j]:
+                shared += 1
+                i += 1
+                j += 1
+            elif films[i] < other_films[j]:
+                i += 1
+            else:
+                j += 1
+        return shared
+
+    def degrees_of_separation(self, actor_id: int, other_actor_id: int, max_degrees: Optional[int] = None) -> Optional[int]:
+        '''
+            Number of films linking two actors: 1 for co-stars, 2 for co-stars of co-stars.
+            None when they are not connected within max_degrees.
+        '''
+        start, goal = self._actor_index.get(actor_id), self._actor_index.get(other_actor_id)
+        if start is None or goal is None:
+            return None
+        if start == goal:
+            return 0
+        seen_actors = bytearray(len(self._actor_ids))
+        seen_films = bytearray(len(self._film_ids))
+        seen_actors[start] = 1
+        queue = deque([(start, 0)])
+        while queue:
+            actor, degrees = queue.popleft()
+            if max_degrees is not None and degrees >= max_degrees:
+                continue
+            for film in self._films_of(actor):
+                if seen_films[film]:
+                    continue
+                seen_films[film] = 1
+                for other in self._actors_of(film):
+                    if other == goal:
+                        return degrees + 1
+                    if not seen_actors[other]:
+                        seen_actors[other] = 1
+                        queue.append((other, degrees + 1))
+        return None
+
+    def __len__(self) -> int:
+        '''Number of film / actor edges'''
+        return len(self._pairs)
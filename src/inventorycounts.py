@@ -0,0 +1,142 @@
+'''
+    Maintained copy counts per film and store.
+
+    Catalog pages show how many copies of each film a store holds and how many are on
+    the shelf. InventoryCounts computes those numbers once with a grouped query over
+    inventory and the open rentals, then keeps them current from the committed rentals
+    and returns of rentals.py instead of grouping inventory on every request. Lookups
+    are dictionary reads, by (film_id, store_id) or for every store of a film:
+
+        counts = InventoryCounts.load(session)
+        add_rental_listener(counts)
+        counts.get(1, 1).available
+        counts.many([(1, 1), (2, 1)])
+
+    Only the rentals and returns made through rentals.py in this process are seen;
+    call refresh() after other writes to inventory or rental, e.g. periodically when
+    several processes rent, or refresh_films() for the films that changed. An event
+    that would take a count below zero or above the number of copies shows such
+    writes: the count is left unchanged, a CountDriftWarning is raised and the film
+    is recomputed by the next refresh_stale().
+'''
+import threading
+import warnings
+from collections import defaultdict
+from typing import Dict, Iterable, NamedTuple, Set, Tuple
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import Select
+from models import Rental, inventory
+from rentals import Checkout, Return
+
+Key = Tuple[int, int]
+
+class Counts(NamedTuple):
+    total: int
+    rented: int
+
+    @property
+    def available(self) -> int:
+        return self.total - self.rented
+
+EMPTY = Counts(0, 0)
+
+class CountDriftWarning(UserWarning):
+    pass
+
+def count_query(film_ids: Iterable[int] = ()) -> Select:
+    '''(film_id, store_id, copies, copies rented out) of every film held by a store'''
+    open_rentals = select(Rental.inventory_id)\
+            .where(Rental.return_date.is_(None))\
+            .group_by(Rental.inventory_id)\
+            .subquery()
+    stmt = select(inventory.c.film_id, inventory.c.store_id, func.count(),
+                  func.count(open_rentals.c.inventory_id))\
+            .outerjoin(open_rentals, open_rentals.c.inventory_id == inventory.c.inventory_id)\
+            .group_by(inventory.c.film_id, inventory.c.store_id)
+    film_ids = list(film_ids)
+    if film_ids:
+        stmt = stmt.where(inventory.c.film_id.in_(film_ids))
+    return stmt
+
+class InventoryCounts():
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts: Dict[Key, Counts] = {}
+        self._by_film: Dict[int, Dict[int, Counts]] = defaultdict(dict)
+        # films whose counts disagreed with a rental event
+        self._stale: Set[int] = set()
+
+    @classmethod
+    def load(cls, session: Session) -> 'InventoryCounts':
+        counts = cls()
+        counts.refresh(session)
+        return counts
+
+    def refresh(self, session: Session) -> None:
+        '''Recompute every count'''
+        rows = session.execute(count_query()).all()
+        with self._lock:
+            self._counts.clear()
+            self._by_film.clear()
+            self._stale.clear()
+            for film_id, store_id, total, rented in rows:
+                self._set((film_id, store_id), Counts(total, rented))
+
+    def refresh_films(self, session: Session, film_ids: Iterable[int]) -> None:
+        film_ids = set(film_ids)
+        if not film_ids:
+            return
+        rows = session.execute(count_query(film_ids)).all()
+        with self._lock:
+            self._stale -= film_ids
+            for film_id in film_ids:
+                for store_id in self._by_film.pop(film_id, {}):
+                    del self._counts[(film_id, store_id)]
+            for film_id, store_id, total, rented in rows:
+                self._set((film_id, store_id), Counts(total, rented))
+
+    def refresh_stale(self, session: Session) -> None:
+        '''Recompute the films whose counts drifted from the database'''
+        with self._lock:
+            stale = set(self._stale)
+        self.refresh_films(session, stale)
+
+    @property
+    def stale(self) -> Set[int]:
+        with self._lock:
+            return set(self._stale)
+
+    def _set(self, key: Key, counts: Counts) -> None:
+        self._counts[key] = counts
+        self._by_film[key[0]][key[1]] = counts
+
+    def _add_rented(self, key: Key, change: int) -> None:
+        with self._lock:
+            current = self._counts.get(key)
+            if current is None:
+                return
+            rented = current.rented + change
+            if 0 <= rented <= current.total:
+                self._set(key, Counts(current.total, rented))
+                return
+            self._stale.add(key[0])
+        warnings.warn(f'{current.rented} of {current.total} copies of film {key[0]} at store {key[1]} '
+                      f'rented before a change of {change:+d}, refresh the film', CountDriftWarning)
+
+    def checked_out(self, checkout: Checkout) -> None:
+        self._add_rented((checkout.film_id, checkout.store_id), 1)
+
+    def returned(self, returned: Return) -> None:
+        self._add_rented((returned.film_id, returned.store_id), -1)
+
+    def get(self, film_id: int, store_id: int) -> Counts:
+        return self._counts.get((film_id, store_id), EMPTY)
+
+    def many(self, keys: Iterable[Key]) -> Dict[Key, Counts]:
+        counts = self._counts
+        return {key: counts.get(key, EMPTY) for key in keys}
+
+    def for_film(self, film_id: int) -> Dict[int, Counts]:
+        '''Counts of the film by store id, the stores holding no copy are left out'''
+        return dict(self._by_film.get(film_id, {}))
@@ -0,0 +1,89 @@
+'''
+    Named loader strategy profiles.
+
+    The relationships in models.py load lazily by default (City.country excepted, a
+    joined many-to-one to a 109 row table). Each use case picks how the related objects
+    it needs are loaded by applying a profile to its query:
+
+        select(Rental).where(...).options(*loader_options('rental_list'))
+        with_profile(select(Film), 'film_detail')
+
+    Profiles end with raiseload('*') so a relationship the use case did not plan for
+    raises instead of silently issuing one query per object.
+'''
+from typing import Dict, NamedTuple, Tuple
+from sqlalchemy.orm import joinedload, raiseload, selectinload, undefer_group
+from sqlalchemy.sql import Select
+from models import Address, City, Customer, Film, Payment, Rental, Staff, Store
+
+class LoaderProfile(NamedTuple):
+    entity: type
+    options: Tuple
+
+PROFILES: Dict[str, LoaderProfile] = {
+    # film page: language, categories and cast plus the description and features
+    'film_detail': LoaderProfile(Film, (
+        joinedload(Film.language),
+        selectinload(Film.categories),
+        selectinload(Film.actors),
+        undefer_group('film_text'),
+        raiseload('*'),
+    )),
+    # catalog listing: titles and categories only
+    'film_list': LoaderProfile(Film, (
+        selectinload(Film.categories),
+        raiseload('*'),
+    )),
+    # rental history tables: who rented and who served, one joined query
+    'rental_list': LoaderProfile(Rental, (
+        joinedload(Rental.customer, innerjoin=True),
+        joinedload(Rental.staff, innerjoin=True),
+        raiseload('*'),
+    )),
+    # single rental: film, customer with address and the payments
+    'rental_detail': LoaderProfile(Rental, (
+        joinedload(Rental.film),
+        joinedload(Rental.customer, innerjoin=True).joinedload(Customer.address).joinedload(Address.city),
+        joinedload(Rental.staff, innerjoin=True),
+        selectinload(Rental.payment),
+        raiseload('*'),
+    )),
+    'customer_detail': LoaderProfile(Customer, (
+        joinedload(Customer.address).joinedload(Address.city).joinedload(City.country),
+        joinedload(Customer.store),
+        raiseload('*'),
+    )),
+    'payment_list': LoaderProfile(Payment, (
+        joinedload(Payment.customer),
+        joinedload(Payment.staff),
+        raiseload('*'),
+    )),
+    'store_detail': LoaderProfile(Store, (
+        joinedload(Store.address).joinedload(Address.city),
+        joinedload(Store.manager),
+        raiseload('*'),
+    )),
+    'staff_list': LoaderProfile(Staff, (
+        joinedload(Staff.address).joinedload(Address.city),
+        raiseload('*'),
+    )),
+}
+
+# columns only, safe with yield_per: bulk exports stream rows and never touch relationships
+EXPORT = 'export'
+
+def loader_options(profile: str) -> Tuple:
+    if profile == EXPORT:
+        return (raiseload('*'),)
+    if profile not in PROFILES:
+        raise ValueError(f'unknown loader profile {profile!r}')
+    return PROFILES[profile].options
+
+def with_profile(stmt: Select, profile: str) -> Select:
+    '''Apply the profile to a select of its entity'''
+    if profile != EXPORT and profile in PROFILES:
+        entity = PROFILES[profile].entity
+        selected = [description['entity'] for description in stmt.column_descriptions]
+        if entity not in selected:
+            raise ValueError(f'loader profile {profile!r} applies to {entity.__name__} queries')
+    return stmt.options(*loader_options(profile))
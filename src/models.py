@@ -2,7 +2,7 @@ from datetime import datetime
 from sqlalchemy import Table, Column, Integer, String, ForeignKey
 from sqlalchemy import TIMESTAMP, TEXT, DECIMAL, SMALLINT, Index, LargeBinary, BOOLEAN
 from sqlalchemy import func, text, Sequence
-from sqlalchemy.orm import relationship, registry
+from sqlalchemy.orm import relationship, registry, deferred
 from sqlalchemy.sql.schema import MetaData
 from sqlalchemy.sql.sqltypes import ARRAY
 
@@ -17,7 +17,12 @@ def create_tsvector(*args):
 
 def to_tsvector_ix(*columns):
     cols = " || ' ' || ".join(columns)
-    return func.to_tsvector('english', text(cols))
+    # a bound 'english' is typed REGCONFIG, which has no literal renderer for the DDL
+    return func.to_tsvector(text("'english'"), text(cols))
+
+def trigram_ix(table, column):
+    '''GIN trigram index of the column, needs the pg_trgm extension, see namesearch.py'''
+    return Index(f'idx_{table}_{column}_trgm', column, postgresql_using='gin', postgresql_ops={column: 'gin_trgm_ops'})
 
 film_category = Table(
     'film_category',
@@ -41,7 +46,8 @@ inventory = Table(
     Column('inventory_id', Integer, Sequence('inventory_inventory_id_seq'), primary_key=True),
     Column('film_id', Integer, ForeignKey('film.film_id')),
     Column('store_id', Integer, ForeignKey('store.store_id')),
-    Column('last_update', TIMESTAMP, nullable=False, default=datetime.utcnow)
+    Column('last_update', TIMESTAMP, nullable=False, default=datetime.utcnow),
+    Index('idx_store_id_film_id', 'store_id', 'film_id')
 )
 
 @mapper_registry.mapped
@@ -51,6 +57,10 @@ class Actor():
     first_name = Column('first_name', String(45), nullable=False)
     last_name = Column('last_name', String(45), nullable=False)
     last_update = Column('last_update', TIMESTAMP, nullable=False, default=datetime.utcnow)
+    __table_args__ = (
+        trigram_ix('actor', 'first_name'),
+        trigram_ix('actor', 'last_name'),
+    )
 
 @mapper_registry.mapped
 class Language():
@@ -64,7 +74,11 @@ class Film():
     __tablename__ = 'film'
     film_id = Column('film_id', Integer, Sequence('film_film_id_seq'), primary_key=True)
     title = Column('title', String(255), nullable=False)
-    description = Column('description', TEXT)
+    '''
+        The wide text columns are deferred as one group and loaded together on first access
+        or with undefer_group('film_text') when a query needs them.
+    '''
+    description = deferred(Column('description', TEXT), group='film_text')
     release_year = Column('release_year', Integer)
     language_id = Column('language_id', Integer, ForeignKey('language.language_id'))
     rental_duration = Column('rental_duration', Integer, nullable=False, default=3)
@@ -73,8 +87,8 @@ class Film():
     replacement_cost = Column('replacement_cost', DECIMAL(5,2), nullable=False, default=19.99)
     rating = Column('rating', String(10), default='G')
     last_update = Column('last_update', TIMESTAMP, nullable=False, default=datetime.utcnow)
-    special_features = Column('special_features', ARRAY(TEXT))
-    fulltext = Column('fulltext', TEXT)
+    special_features = deferred(Column('special_features', ARRAY(TEXT)), group='film_text')
+    fulltext = deferred(Column('fulltext', TEXT), group='film_text')
 
     language = relationship('Language')
     categories = relationship('Category', secondary=film_category, backref='films')
@@ -116,7 +130,11 @@ class Staff():
     username = Column('username', String(16), nullable=False)
     password = Column('password', String(40))
     last_update = Column('last_update', TIMESTAMP, nullable=False, default=datetime.utcnow)
-    picture = Column('picture', LargeBinary)
+    '''
+        The picture is deferred so select(Staff) and joined loads of Rental.staff do not
+        transfer it, use blobs.py to read or write it in chunks.
+    '''
+    picture = deferred(Column('picture', LargeBinary), group='picture')
 
     '''
         This assume the staff can be a manager for multiple store.
@@ -180,8 +198,21 @@ class Rental():
     last_update = Column('last_update', TIMESTAMP, nullable=False, default=datetime.utcnow)
     # use of overlaps="stores,stores" for valid relationship in this case.
     film = relationship('Film', secondary=inventory, uselist=False, overlaps="stores,stores")
-    staff = relationship('Staff', lazy='joined', innerjoin=True)
-    customer = relationship('Customer', lazy='joined', innerjoin=True)
+    '''
+        Staff and customer load lazily, lists of rentals join them with the rental_list
+        loader profile, see loaders.py
+    '''
+    staff = relationship('Staff')
+    customer = relationship('Customer')
+    '''
+        Rental is range partitioned by month on rental_date, see partitions.py
+    '''
+    __table_args__ = (
+        Index('idx_unq_rental_rental_date_inventory_id_customer_id', 'rental_date', 'inventory_id', 'customer_id', unique=True),
+        # a copy has at most one open rental, see rentals.py
+        Index('idx_unq_rental_open_inventory_id', 'inventory_id', unique=True, postgresql_where=text('return_date IS NULL')),
+        {'info': {'partition_key': 'rental_date'}}
+    )
 
 @mapper_registry.mapped
 class Customer():
@@ -199,6 +230,14 @@ class Customer():
 
     store = relationship('Store')
     address = relationship('Address')
+    '''
+        Name search matches partial names anywhere in these columns, see namesearch.py
+    '''
+    __table_args__ = (
+        trigram_ix('customer', 'first_name'),
+        trigram_ix('customer', 'last_name'),
+        trigram_ix('customer', 'email'),
+    )
 
 @mapper_registry.mapped
 class Payment():
@@ -213,3 +252,7 @@ class Payment():
     customer = relationship('Customer')
     staff = relationship('Staff')
     rental = relationship('Rental', backref='payment')
+    '''
+        Payment is range partitioned by month on payment_date, see partitions.py
+    '''
+    __table_args__ = {'info': {'partition_key': 'payment_date'}}
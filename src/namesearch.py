@@ -0,0 +1,89 @@
+'''
+    Partial name search on customers and actors.
+
+    Front desk staff type part of a name or email, e.g. "penel" or "smi". Every word
+    typed must be close to a word of one of the searched columns by pg_trgm word
+    similarity (word <% column, pg_trgm.word_similarity_threshold, 0.6 by default), so
+    misspellings match too, and the results are ranked by the summed similarity of the
+    words. autocomplete() matches the names starting with the typed prefix. Both use the
+    GIN trigram indexes declared on the models instead of scanning the table with
+    ILIKE '%...%', install_trigram_indexes() creates the extension and the indexes.
+
+        search(session, Customer, 'mary smit')
+        autocomplete(session, Actor, 'gui')
+'''
+import operator
+from functools import reduce
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from sqlalchemy import Column, and_, func, literal, or_, select
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import Select
+from models import Actor, Customer
+
+SEARCH_COLUMNS: Dict[type, Tuple[Column, ...]] = {
+    Customer: (Customer.first_name, Customer.last_name, Customer.email),
+    Actor: (Actor.first_name, Actor.last_name),
+}
+DEFAULT_LIMIT = 10
+# upper bound of any limit asked for
+MAX_RESULTS = 50
+
+class Match(NamedTuple):
+    entity: object
+    score: float
+
+def _columns(entity: type) -> Tuple[Column, ...]:
+    if entity not in SEARCH_COLUMNS:
+        raise ValueError(f'name search does not support {entity.__name__}')
+    return SEARCH_COLUMNS[entity]
+
+def _bounded(limit: int) -> int:
+    return max(1, min(limit, MAX_RESULTS))
+
+def _escape_like(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def install_trigram_indexes(conn: Connection) -> None:
+    conn.exec_driver_sql('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for entity in SEARCH_COLUMNS:
+        for index in entity.__table__.indexes:
+            if index.name.endswith('_trgm'):
+                index.create(conn, checkfirst=True)
+
+def search_query(entity: type, term: str, limit: int = DEFAULT_LIMIT) -> Optional[Select]:
+    '''Select of (entity, score) best matches first, None when the term has no words'''
+    columns = _columns(entity)
+    words = term.split()
+    if not words:
+        return None
+    matches = [or_(*(literal(word).op('<%')(column) for column in columns)) for word in words]
+    # greatest() skips the NULL similarity of a missing email
+    similarities = [func.greatest(*(func.word_similarity(word, column) for column in columns)) for word in words]
+    score = reduce(operator.add, similarities).label('score')
+    return select(entity, score)\
+            .where(and_(*matches))\
+            .order_by(score.desc(), entity.__mapper__.primary_key[0])\
+            .limit(_bounded(limit))
+
+def search(session: Session, entity: type, term: str, limit: int = DEFAULT_LIMIT) -> List[Match]:
+    stmt = search_query(entity, term, limit)
+    if stmt is None:
+        return []
+    return [Match(found, float(score)) for found, score in session.execute(stmt)]
+
+def autocomplete_query(entity: type, prefix: str, limit: int = DEFAULT_LIMIT) -> Optional[Select]:
+    '''Select of the entities with a searched column starting with the prefix, case insensitive'''
+    columns = _columns(entity)
+    prefix = prefix.strip()
+    if not prefix:
+        return None
+    pattern = f'{_escape_like(prefix)}%'
+    return select(entity)\
+            .where(or_(*(column.ilike(pattern, escape='\\') for column in columns)))\
+            .order_by(entity.last_name, entity.first_name, entity.__mapper__.primary_key[0])\
+            .limit(_bounded(limit))
+
+def autocomplete(session: Session, entity: type, prefix: str, limit: int = DEFAULT_LIMIT) -> List[object]:
+    stmt = autocomplete_query(entity, prefix, limit)
+    return session.execute(stmt).scalars().all() if stmt is not None else []
@@ -0,0 +1,130 @@
+'''
+    Overdue rental detection.
+
+    A rental is overdue once rental_date + film.rental_duration days has passed without a
+    return_date. install_due_date() adds a rental.due_date column maintained by a
+    BEFORE INSERT / UPDATE trigger from the film of the rented copy, fills it for the
+    existing rentals and indexes it for open rentals only:
+
+        CREATE INDEX idx_rental_open_due_date ON rental (due_date) WHERE return_date IS NULL
+
+    so finding the overdue rentals reads the few open rentals through that index instead
+    of joining every rental to inventory and film. OverdueScanner keeps the due date it
+    scanned up to and only returns the rentals that fell overdue since its last scan.
+
+    due_date is not mapped on Rental since databases without install_due_date() do not
+    have it, the queries use the rental table declared here.
+'''
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional
+from sqlalchemy import Column, Integer, MetaData, Table, TIMESTAMP, select, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql import Select
+from models import inventory
+
+metadata = MetaData(schema='public')
+
+rental = Table(
+    'rental',
+    metadata,
+    Column('rental_id', Integer, primary_key=True),
+    Column('rental_date', TIMESTAMP, nullable=False),
+    Column('inventory_id', Integer, nullable=False),
+    Column('customer_id', Integer, nullable=False),
+    Column('return_date', TIMESTAMP),
+    Column('due_date', TIMESTAMP),
+)
+
+class OverdueRental(NamedTuple):
+    rental_id: int
+    store_id: int
+    customer_id: int
+    inventory_id: int
+    film_id: int
+    rental_date: datetime
+    due_date: datetime
+
+def _has_trigger(conn: Connection, name: str) -> bool:
+    return conn.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_trigger WHERE tgrelid = CAST('public.rental' AS regclass) AND tgname = :name)"
+    ), {'name': name}).scalar_one()
+
+def install_due_date(conn: Connection) -> None:
+    '''Add, fill and index rental.due_date and create the trigger keeping it current'''
+    conn.execute(text('ALTER TABLE public.rental ADD COLUMN IF NOT EXISTS due_date timestamp without time zone'))
+    conn.execute(text('''
+        CREATE OR REPLACE FUNCTION public.rental_due_date() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            SELECT NEW.rental_date + f.rental_duration * interval '1 day' INTO NEW.due_date
+            FROM public.inventory i JOIN public.film f ON f.film_id = i.film_id
+            WHERE i.inventory_id = NEW.inventory_id;
+            RETURN NEW;
+        END
+        $$'''))
+    conn.execute(text('DROP TRIGGER IF EXISTS rental_due_date ON public.rental'))
+    conn.execute(text(
+        'CREATE TRIGGER rental_due_date BEFORE INSERT OR UPDATE OF rental_date, inventory_id ON public.rental '
+        'FOR EACH ROW EXECUTE PROCEDURE public.rental_due_date()'
+    ))
+    # indexed before the backfill: the backfill would leave broken HOT chains and the
+    # index would not be usable in the transaction creating it
+    conn.execute(text(
+        'CREATE INDEX IF NOT EXISTS idx_rental_open_due_date ON public.rental (due_date) WHERE return_date IS NULL'
+    ))
+    backfill_due_dates(conn)
+
+def backfill_due_dates(conn: Connection, open_only: bool = False) -> int:
+    '''
+        Recompute due_date from the film rental durations, e.g. after a rental_duration
+        change. The last_updated trigger is disabled meanwhile so last_update keeps
+        telling when the rental itself last changed.
+    '''
+    restore = _has_trigger(conn, 'last_updated')
+    if restore:
+        conn.execute(text('ALTER TABLE public.rental DISABLE TRIGGER last_updated'))
+    updated = conn.execute(text(f'''
+        UPDATE public.rental r SET due_date = r.rental_date + f.rental_duration * interval '1 day'
+        FROM public.inventory i JOIN public.film f ON f.film_id = i.film_id
+        WHERE i.inventory_id = r.inventory_id{' AND r.return_date IS NULL' if open_only else ''}
+    ''')).rowcount
+    if restore:
+        conn.execute(text('ALTER TABLE public.rental ENABLE TRIGGER last_updated'))
+    return updated
+
+def overdue_query(now: datetime, store_id: Optional[int] = None, since: Optional[datetime] = None) -> Select:
+    '''Open rentals due before now, and due after since when given, in due date order'''
+    stmt = select(rental.c.rental_id, inventory.c.store_id, rental.c.customer_id, rental.c.inventory_id,
+                  inventory.c.film_id, rental.c.rental_date, rental.c.due_date)\
+            .join(inventory, inventory.c.inventory_id == rental.c.inventory_id)\
+            .where(rental.c.return_date.is_(None), rental.c.due_date < now)\
+            .order_by(rental.c.due_date, rental.c.rental_id)
+    if since is not None:
+        stmt = stmt.where(rental.c.due_date >= since)
+    if store_id is not None:
+        stmt = stmt.where(inventory.c.store_id == store_id)
+    return stmt
+
+def overdue_rentals(conn: Connection, store_id: Optional[int] = None, now: Optional[datetime] = None) -> List[OverdueRental]:
+    return [OverdueRental(*row) for row in conn.execute(overdue_query(now or datetime.utcnow(), store_id))]
+
+def by_store(rentals: List[OverdueRental]) -> Dict[int, List[OverdueRental]]:
+    stores: Dict[int, List[OverdueRental]] = defaultdict(list)
+    for overdue in rentals:
+        stores[overdue.store_id].append(overdue)
+    return dict(stores)
+
+class OverdueScanner():
+    '''
+        Incremental scan: every call returns the open rentals whose due date passed since
+        the previous call, the first call returns every overdue rental.
+    '''
+    def __init__(self, store_id: Optional[int] = None, watermark: Optional[datetime] = None):
+        self.store_id = store_id
+        self.watermark = watermark
+
+    def scan(self, conn: Connection, now: Optional[datetime] = None) -> List[OverdueRental]:
+        now = now or datetime.utcnow()
+        rows = conn.execute(overdue_query(now, self.store_id, self.watermark)).all()
+        self.watermark = now
+        return [OverdueRental(*row) for row in rows]
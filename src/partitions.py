@@ -0,0 +1,276 @@
+'''
+    Monthly range partitioning for the payment and rental tables.
+
+    The mapped tables name their partition key in Table.info['partition_key']
+    (see Payment and Rental in models.py). partition_table() converts the plain
+    table restored from dvdrental.tar into a table partitioned by month on that
+    column, ensure_partitions() / drop_partitions_before() manage the monthly
+    partitions, and the query helpers always add a range predicate on the partition
+    key so Postgres can prune the partitions a query does not need.
+'''
+import re
+import warnings
+from datetime import date, datetime, time
+from typing import List, Optional, Tuple, Union
+from sqlalchemy import Column, Table, event, select, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql import ColumnElement, Select, visitors
+from models import Payment, Rental
+
+DateLike = Union[date, datetime]
+
+PARTITION_NAME = re.compile(r'_p(\d{4})_(\d{2})$')
+
+class PartitionPruningWarning(UserWarning):
+    pass
+
+class DroppedForeignKeyWarning(UserWarning):
+    pass
+
+def partition_key(table: Table) -> Column:
+    '''Return the column a mapped table is range partitioned on'''
+    return table.c[table.info['partition_key']]
+
+def month_start(value: DateLike) -> date:
+    return date(value.year, value.month, 1)
+
+def next_month(month: date) -> date:
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+def month_bounds(value: DateLike) -> Tuple[datetime, datetime]:
+    '''Return the [start, end) timestamps of the month containing value'''
+    start = month_start(value)
+    return datetime.combine(start, time.min), datetime.combine(next_month(start), time.min)
+
+def partition_name(table: Table, month: DateLike) -> str:
+    return f'{table.name}_p{month.year:04d}_{month.month:02d}'
+
+def _qualified(table: Table, name: Optional[str] = None) -> str:
+    return f'{table.schema or "public"}.{name or table.name}'
+
+def _exists(conn: Connection, table: Table, name: str) -> bool:
+    return conn.execute(text('SELECT to_regclass(:name) IS NOT NULL'), {'name': _qualified(table, name)}).scalar_one()
+
+def _triggers_per_partition(conn: Connection) -> bool:
+    '''Postgres 12 cannot create BEFORE ... FOR EACH ROW triggers on a partitioned table'''
+    return conn.dialect.server_version_info < (13,)
+
+def _is_before_row(definition: str) -> bool:
+    return ' BEFORE ' in definition and ' FOR EACH ROW ' in definition
+
+def _copy_row_triggers(conn: Connection, table: Table, name: str) -> None:
+    '''
+        Before Postgres 13 the BEFORE ROW triggers of the table live on each partition,
+        create the ones of the default partition on the partition name
+    '''
+    default = f'{table.name}_default'
+    if name == default or not _triggers_per_partition(conn) or not _exists(conn, table, default):
+        return
+    triggers = conn.execute(text(
+        'SELECT pg_get_triggerdef(oid) FROM pg_trigger WHERE tgrelid = CAST(:table AS regclass) AND NOT tgisinternal'
+    ), {'table': _qualified(table, default)}).scalars().all()
+    for definition in triggers:
+        if _is_before_row(definition):
+            conn.execute(text(definition.replace(f' ON {_qualified(table, default)} ', f' ON {_qualified(table, name)} ')))
+
+def create_month_partition(conn: Connection, table: Table, month: DateLike) -> str:
+    '''
+        Create the partition of the month. Rows of the month already routed to the default
+        partition, e.g. payments of a month created late, are moved into it: the default
+        partition is detached, the rows are copied into the new table before it is
+        attached, and the default partition is attached again.
+    '''
+    start = month_start(month)
+    end = next_month(start)
+    name = partition_name(table, start)
+    qualified = _qualified(table, name)
+    bounds = f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+    if _exists(conn, table, name):
+        return name
+    default = _qualified(table, f'{table.name}_default')
+    key = partition_key(table).name
+    in_month = f"{key} >= '{start.isoformat()}' AND {key} < '{end.isoformat()}'"
+    if _exists(conn, table, f'{table.name}_default') and \
+            conn.execute(text(f'SELECT EXISTS (SELECT 1 FROM {default} WHERE {in_month})')).scalar_one():
+        conn.execute(text(f'ALTER TABLE {_qualified(table)} DETACH PARTITION {default}'))
+        conn.execute(text(
+            f'CREATE TABLE {qualified} (LIKE {_qualified(table)} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE)'
+        ))
+        conn.execute(text(f'INSERT INTO {qualified} SELECT * FROM {default} WHERE {in_month}'))
+        conn.execute(text(f'DELETE FROM {default} WHERE {in_month}'))
+        conn.execute(text(f'ALTER TABLE {_qualified(table)} ATTACH PARTITION {qualified} {bounds}'))
+        conn.execute(text(f'ALTER TABLE {_qualified(table)} ATTACH PARTITION {default} DEFAULT'))
+    else:
+        conn.execute(text(f'CREATE TABLE {qualified} PARTITION OF {_qualified(table)} {bounds}'))
+    _copy_row_triggers(conn, table, name)
+    return name
+
+def ensure_partitions(conn: Connection, table: Table, start: DateLike, end: DateLike) -> List[str]:
+    '''Create the monthly partitions covering start to end (inclusive) if they do not exist'''
+    names = []
+    month = month_start(start)
+    while month <= month_start(end):
+        names.append(create_month_partition(conn, table, month))
+        month = next_month(month)
+    return names
+
+def list_partitions(conn: Connection, table: Table) -> List[Tuple[str, Optional[date]]]:
+    '''
+        Return (partition name, month) for every partition of the table. The month is
+        None for partitions not created by this module such as the default partition.
+    '''
+    rows = conn.execute(text('''
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        JOIN pg_namespace n ON n.oid = p.relnamespace
+        WHERE p.relname = :table AND n.nspname = :schema
+        ORDER BY c.relname
+    '''), {'table': table.name, 'schema': table.schema or 'public'}).scalars().all()
+    partitions = []
+    for name in rows:
+        match = PARTITION_NAME.search(name)
+        partitions.append((name, date(int(match.group(1)), int(match.group(2)), 1) if match else None))
+    return partitions
+
+def drop_partitions_before(conn: Connection, table: Table, cutoff: DateLike) -> List[str]:
+    '''Detach and drop the monthly partitions that end on or before the month of cutoff'''
+    dropped = []
+    for name, month in list_partitions(conn, table):
+        if month is not None and next_month(month) <= month_start(cutoff):
+            conn.execute(text(f'ALTER TABLE {_qualified(table)} DETACH PARTITION {_qualified(table, name)}'))
+            conn.execute(text(f'DROP TABLE {_qualified(table, name)}'))
+            dropped.append(name)
+    return dropped
+
+def partition_table(conn: Connection, table: Table) -> str:
+    '''
+        Convert a plain table into a table range partitioned by month on its partition key.
+
+        The existing table is renamed to <name>_unpartitioned and kept so the copy can be
+        verified before it is dropped. The new table gets the columns, defaults, indexes,
+        foreign keys and triggers of the old one, a primary key extended with the partition
+        key, a partition for every month holding data and a default partition. Views using
+        the table are recreated on top of the new table.
+
+        Postgres cannot reference a partitioned table by a key that does not include the
+        partition key, so foreign keys pointing at the table (payment.rental_id when rental
+        is converted) are dropped with a DroppedForeignKeyWarning. Postgres 12 does not
+        support BEFORE ROW triggers such as the last_updated trigger of rental on a
+        partitioned table, they are created on every partition instead, including the
+        partitions created later by ensure_partitions(). Run it in a transaction, all of it
+        is transactional DDL.
+    '''
+    qualified = _qualified(table)
+    legacy = f'{table.name}_unpartitioned'
+    key = partition_key(table)
+    primary_key = ', '.join([c.name for c in table.primary_key.columns] + [key.name])
+
+    indexes = conn.execute(text(
+        'SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = :schema AND tablename = :table'
+    ), {'schema': table.schema or 'public', 'table': table.name}).all()
+    foreign_keys = conn.execute(text(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = CAST(:table AS regclass) AND contype = 'f'"
+    ), {'table': qualified}).all()
+    inbound_keys = conn.execute(text(
+        "SELECT conname, CAST(conrelid AS regclass) FROM pg_constraint WHERE confrelid = CAST(:table AS regclass) AND contype = 'f'"
+    ), {'table': qualified}).all()
+    triggers = conn.execute(text(
+        'SELECT tgname, pg_get_triggerdef(oid) FROM pg_trigger WHERE tgrelid = CAST(:table AS regclass) AND NOT tgisinternal'
+    ), {'table': qualified}).all()
+    views = conn.execute(text('''
+        SELECT DISTINCT CAST(v.oid AS regclass), pg_get_viewdef(v.oid)
+        FROM pg_depend d JOIN pg_rewrite r ON r.oid = d.objid JOIN pg_class v ON v.oid = r.ev_class
+        WHERE d.refobjid = CAST(:table AS regclass) AND v.oid <> d.refobjid
+    '''), {'table': qualified}).all()
+    sequences = conn.execute(text(
+        'SELECT column_name, pg_get_serial_sequence(:table, column_name) FROM information_schema.columns '
+        'WHERE table_schema = :schema AND table_name = :name'
+    ), {'table': qualified, 'schema': table.schema or 'public', 'name': table.name}).all()
+    first, last = conn.execute(text(f'SELECT min({key.name}), max({key.name}) FROM {qualified}')).one()
+
+    for constraint, referencing_table in inbound_keys:
+        warnings.warn(f'dropping foreign key {constraint} of {referencing_table} referencing {qualified}',
+                      DroppedForeignKeyWarning)
+        conn.execute(text(f'ALTER TABLE {referencing_table} DROP CONSTRAINT {constraint}'))
+    conn.execute(text(f'ALTER TABLE {qualified} RENAME TO {legacy}'))
+    for index_name, _ in indexes:
+        conn.execute(text(f'ALTER INDEX {_qualified(table, index_name)} RENAME TO {index_name}_unpartitioned'))
+    for constraint, _ in foreign_keys:
+        conn.execute(text(f'ALTER TABLE {_qualified(table, legacy)} RENAME CONSTRAINT {constraint} TO {constraint}_unpartitioned'))
+    for trigger, _ in triggers:
+        conn.execute(text(f'DROP TRIGGER {trigger} ON {_qualified(table, legacy)}'))
+
+    conn.execute(text(
+        f'CREATE TABLE {qualified} (LIKE {_qualified(table, legacy)} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE) '
+        f'PARTITION BY RANGE ({key.name})'
+    ))
+    conn.execute(text(f'ALTER TABLE {qualified} ADD CONSTRAINT {table.name}_pkey PRIMARY KEY ({primary_key})'))
+    for index_name, definition in indexes:
+        # the primary key is recreated above and unique indexes must contain the partition key
+        if index_name == f'{table.name}_pkey' or (definition.startswith('CREATE UNIQUE') and key.name not in definition):
+            continue
+        conn.execute(text(definition))
+    for constraint, definition in foreign_keys:
+        conn.execute(text(f'ALTER TABLE {qualified} ADD CONSTRAINT {constraint} {definition}'))
+    default = _qualified(table, table.name + '_default')
+    conn.execute(text(f'CREATE TABLE {default} PARTITION OF {qualified} DEFAULT'))
+    for _, definition in triggers:
+        if _is_before_row(definition) and _triggers_per_partition(conn):
+            definition = definition.replace(f' ON {qualified} ', f' ON {default} ')
+        conn.execute(text(definition))
+    for column_name, sequence in sequences:
+        if sequence is not None:
+            conn.execute(text(f'ALTER SEQUENCE {sequence} OWNED BY {qualified}.{column_name}'))
+
+    if first is not None:
+        ensure_partitions(conn, table, first, last)
+    conn.execute(text(f'INSERT INTO {qualified} SELECT * FROM {_qualified(table, legacy)}'))
+    for view, definition in views:
+        conn.execute(text(f'CREATE OR REPLACE VIEW {view} AS {definition}'))
+    return legacy
+
+def in_range(column: Column, start: DateLike, end: DateLike) -> ColumnElement:
+    '''Half open [start, end) predicate on a partition key'''
+    return (column >= start) & (column < end)
+
+def payments_between(start: DateLike, end: DateLike) -> Select:
+    return select(Payment).where(in_range(Payment.payment_date, start, end))
+
+def rentals_between(start: DateLike, end: DateLike) -> Select:
+    return select(Rental).where(in_range(Rental.rental_date, start, end))
+
+def payments_in_month(month: DateLike) -> Select:
+    return payments_between(*month_bounds(month))
+
+def rentals_in_month(month: DateLike) -> Select:
+    return rentals_between(*month_bounds(month))
+
+def has_partition_predicate(stmt: Select, table: Table) -> bool:
+    '''True when the WHERE clause of the statement references the partition key of the table'''
+    if stmt.whereclause is None:
+        return False
+    key = partition_key(table)
+    return any(isinstance(element, Column) and _is_table(element.table, table) and element.name == key.name
+               for element in visitors.iterate(stmt.whereclause))
+
+def _is_table(element, table: Table) -> bool:
+    # ORM statements carry annotated copies of the tables, compare by name
+    return isinstance(element, Table) and element.fullname == table.fullname
+
+def warn_on_unpruned_queries(session_factory) -> None:
+    '''
+        Install a do_orm_execute listener on a Session or sessionmaker that warns when a
+        select reads a partitioned table without a predicate on its partition key, i.e.
+        a query that scans every partition. Relationship lazy loads are not checked.
+    '''
+    @event.listens_for(session_factory, 'do_orm_execute')
+    def _check_partition_predicate(orm_execute_state):
+        if not orm_execute_state.is_select or orm_execute_state.is_relationship_load:
+            return
+        stmt = orm_execute_state.statement
+        for table in (Payment.__table__, Rental.__table__):
+            if any(_is_table(element, table) for from_ in stmt.get_final_froms() for element in visitors.iterate(from_)) \
+                    and not has_partition_predicate(stmt, table):
+                warnings.warn(f'query on {table.name} has no {partition_key(table).name} predicate '
+                              'and scans every partition', PartitionPruningWarning)
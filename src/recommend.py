@@ -0,0 +1,117 @@
+'''
+    "Customers who rented this also rented" film recommendations.
+
+    Rental history is kept as a sparse binary customer x film matrix X. The film x
+    film co-occurrence matrix C = X^T X holds how many customers rented both films,
+    and the cosine similarity of two films is C[f, g] / sqrt(C[f, f] * C[g, g]). The
+    top K most similar films are cached per film.
+
+    New rentals arrive as a sparse matrix D of customer / film pairs not seen before,
+    C is updated with D^T X + X^T D + D^T D and only the films whose co-occurrence
+    row or norm changed get their neighbours recomputed.
+'''
+from typing import Dict, Iterable, List, Optional, Tuple
+import numpy as np
+from scipy import sparse
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from models import Rental, inventory
+
+TOP_K = 10
+
+class FilmRecommender():
+    def __init__(self, top_k: int = TOP_K):
+        self.top_k = top_k
+        self.watermark = 0
+        self._customer_index: Dict[int, int] = {}
+        self._film_index: Dict[int, int] = {}
+        self._film_ids: List[int] = []
+        self._rentals = sparse.csr_matrix((0, 0), dtype=np.float64)
+        self._cooccurrence = sparse.csr_matrix((0, 0), dtype=np.float64)
+        self._neighbors: Dict[int, List[Tuple[int, float]]] = {}
+
+    @classmethod
+    def load(cls, session: Session, top_k: int = TOP_K) -> 'FilmRecommender':
+        recommender = cls(top_k)
+        recommender.refresh(session)
+        return recommender
+
+    def refresh(self, session: Session) -> int:
+        '''Add the rentals with a rental_id above the watermark, returns the number of new customer / film pairs'''
+        rows = session.execute(
+            select(Rental.rental_id, Rental.customer_id, inventory.c.film_id)
+            .join(inventory, inventory.c.inventory_id == Rental.inventory_id)
+            .where(Rental.rental_id > self.watermark)
+        ).all()
+        if rows:
+            self.watermark = max(row.rental_id for row in rows)
+        return self.add_rentals((row.customer_id, row.film_id) for row in rows)
+
+    def add_rentals(self, rentals: Iterable[Tuple[int, int]]) -> int:
+        '''Add (customer_id, film_id) rentals, returns the number of customer / film pairs not seen before'''
+        rows, cols = [], []
+        for customer_id, film_id in rentals:
+            rows.append(self._customer_index.setdefault(customer_id, len(self._customer_index)))
+            if film_id not in self._film_index:
+                self._film_index[film_id] = len(self._film_ids)
+                self._film_ids.append(film_id)
+            cols.append(self._film_index[film_id])
+        if not rows:
+            return 0
+
+        shape = (len(self._customer_index), len(self._film_ids))
+        self._rentals.resize(shape)
+        self._cooccurrence.resize((shape[1], shape[1]))
+        delta = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=shape)
+        # repeated rentals of the same film count once
+        delta.data[:] = 1.0
+        delta = (delta - delta.multiply(self._rentals)).tocsr()
+        delta.eliminate_zeros()
+        if delta.nnz == 0:
+            return 0
+
+        change = (delta.T @ self._rentals).tocsr()
+        change = change + change.T + delta.T @ delta
+        self._rentals = (self._rentals + delta).tocsr()
+        self._cooccurrence = (self._cooccurrence + change).tocsr()
+
+        # films with a changed norm change the similarity of every film they co-occur with
+        changed_films = np.unique(delta.indices)
+        affected = np.union1d(change.tocoo().row, self._cooccurrence[:, changed_films].tocoo().row)
+        self._update_neighbors(affected)
+        return delta.nnz
+
+    def _update_neighbors(self, films: np.ndarray) -> None:
+        norms = np.sqrt(self._cooccurrence.diagonal())
+        inverse = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+        similarity = (sparse.diags(inverse[films]) @ self._cooccurrence[films] @ sparse.diags(inverse)).tocsr()
+        film_ids = np.asarray(self._film_ids)
+        for row, film in enumerate(films):
+            start, end = similarity.indptr[row], similarity.indptr[row + 1]
+            indices, scores = similarity.indices[start:end], similarity.data[start:end]
+            keep = indices != film
+            indices, scores = indices[keep], scores[keep]
+            if len(scores) > self.top_k:
+                top = np.argpartition(-scores, self.top_k)[:self.top_k]
+                indices, scores = indices[top], scores[top]
+            order = np.lexsort((film_ids[indices], -scores))
+            self._neighbors[self._film_ids[film]] = [
+                (self._film_ids[indices[i]], float(scores[i])) for i in order
+            ]
+
+    def similar_films(self, film_id: int, limit: Optional[int] = None) -> List[Tuple[int, float]]:
+        '''(film_id, cosine similarity) of the films most often rented by the same customers'''
+        return self._neighbors.get(film_id, [])[:limit]
+
+    def recommend_for_customer(self, customer_id: int, limit: int = TOP_K) -> List[Tuple[int, float]]:
+        '''Films similar to the customer's rentals that the customer has not rented, by summed similarity'''
+        row = self._customer_index.get(customer_id)
+        if row is None:
+            return []
+        rented = {self._film_ids[film] for film in self._rentals[row].indices}
+        scores: Dict[int, float] = {}
+        for film_id in rented:
+            for other, score in self._neighbors.get(film_id, []):
+                if other not in rented:
+                    scores[other] = scores.get(other, 0.0) + score
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]
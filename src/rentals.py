@@ -0,0 +1,226 @@
+'''
+    Rental checkout and return.
+
+    Checkout allocates an available inventory copy of a film at a store with
+    SELECT ... FOR UPDATE SKIP LOCKED, so concurrent clerks renting the same popular
+    film each lock a different copy instead of queueing on the first one, and inserts
+    the rental and its payment in the same transaction. The partial unique index
+    idx_unq_rental_open_inventory_id (see install_open_rental_index()) guarantees a
+    copy never has two open rentals, even for writers not using this module.
+
+    Both operations take a sessionmaker rather than a session: a transaction that
+    fails with a serialization failure or deadlock is retried from the start in a
+    new session. rent() and return_open_rental() do the same work in a session the
+    caller commits. The registered rental listeners, see add_rental_listener(), are
+    notified when the session transaction commits, whichever of them was used.
+'''
+import random
+import time
+from datetime import datetime
+from decimal import Decimal
+from typing import Callable, List, NamedTuple, Optional, Protocol, TypeVar
+from sqlalchemy import event, select, update, exists
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session, sessionmaker
+from models import Film, Rental, Payment, inventory
+
+T = TypeVar('T')
+
+# serialization_failure and deadlock_detected
+RETRYABLE_SQLSTATES = ('40001', '40P01')
+UNIQUE_VIOLATION = '23505'
+OPEN_RENTAL_INDEX = 'idx_unq_rental_open_inventory_id'
+MAX_ATTEMPTS = 5
+RETRY_BACKOFF = 0.05
+
+class InventoryUnavailableError(Exception):
+    pass
+
+class RentalNotOpenError(Exception):
+    pass
+
+class Checkout(NamedTuple):
+    rental_id: int
+    payment_id: int
+    inventory_id: int
+    film_id: int
+    store_id: int
+    rental_date: datetime
+    amount: Decimal
+
+class Return(NamedTuple):
+    rental_id: int
+    inventory_id: int
+    film_id: int
+    store_id: int
+    return_date: datetime
+
+class RentalListener(Protocol):
+    def checked_out(self, checkout: Checkout) -> None: ...
+    def returned(self, returned: Return) -> None: ...
+
+_listeners: List[RentalListener] = []
+
+def add_rental_listener(listener: RentalListener) -> None:
+    '''
+        Call listener.checked_out() and listener.returned() for every rent() and
+        return_open_rental() of this process once their session commits, checkout()
+        and return_rental() included. Listeners run in the committing thread and must
+        not raise, the transaction is already committed.
+    '''
+    _listeners.append(listener)
+
+def remove_rental_listener(listener: RentalListener) -> None:
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+# (transaction, method, value) of the session transaction, sent to the listeners when it commits
+_PENDING_EVENTS = 'rental_events'
+
+def _notify_on_commit(session: Session, method: str, value) -> None:
+    transaction = session.get_nested_transaction() or session.get_transaction()
+    session.info.setdefault(_PENDING_EVENTS, []).append((transaction, method, value))
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session: Session) -> None:
+    for _, method, value in session.info.pop(_PENDING_EVENTS, ()):
+        for listener in list(_listeners):
+            getattr(listener, method)(value)
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _after_soft_rollback(session: Session, previous_transaction) -> None:
+    '''Drop the events of a rolled back savepoint'''
+    if previous_transaction.nested:
+        session.info[_PENDING_EVENTS] = [pending for pending in session.info.get(_PENDING_EVENTS, ())
+                                         if pending[0] is not previous_transaction]
+
+@event.listens_for(Session, 'after_transaction_end')
+def _after_transaction_end(session: Session, transaction) -> None:
+    '''Rollback, close() without commit or commit, after_commit already sent the events'''
+    if transaction.parent is None:
+        session.info.pop(_PENDING_EVENTS, None)
+
+def is_retryable(error: DBAPIError) -> bool:
+    '''Serialization failures, deadlocks and a copy rented by another transaction meanwhile'''
+    code = getattr(error.orig, 'pgcode', None)
+    if code == UNIQUE_VIOLATION:
+        return getattr(getattr(error.orig, 'diag', None), 'constraint_name', None) == OPEN_RENTAL_INDEX
+    return code in RETRYABLE_SQLSTATES
+
+def install_open_rental_index(conn: Connection) -> None:
+    '''Create the partial unique index on rental (inventory_id) WHERE return_date IS NULL'''
+    next(index for index in Rental.__table__.indexes if index.name == OPEN_RENTAL_INDEX).create(conn, checkfirst=True)
+
+def run_in_transaction(session_factory: sessionmaker, work: Callable[[Session], T],
+                       attempts: int = MAX_ATTEMPTS, backoff: float = RETRY_BACKOFF) -> T:
+    '''
+        Run work(session) in its own transaction and commit it. Serialization failures
+        and deadlocks roll back and run work again in a new session after a jittered
+        exponential backoff, any other error is raised.
+    '''
+    for attempt in range(1, attempts + 1):
+        with session_factory() as session:
+            try:
+                result = work(session)
+                session.commit()
+                return result
+            except DBAPIError as error:
+                session.rollback()
+                if not is_retryable(error) or attempt == attempts:
+                    raise
+        time.sleep(backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+    raise AssertionError('unreachable')
+
+def _rented_out(inventory_id):
+    return exists().where(Rental.inventory_id == inventory_id, Rental.return_date.is_(None))
+
+def allocate_inventory(session: Session, film_id: int, store_id: int) -> Optional[int]:
+    '''
+        Lock and return the id of a copy of the film at the store that is not rented
+        out, skipping copies other transactions are allocating right now.
+
+        The open rental filter sees the snapshot taken when the statement started, a
+        rental of the copy committed between that snapshot and taking the lock passes
+        it. Once locked, the copy is checked again in a new statement, which sees that
+        rental at READ COMMITTED, and the next copy is tried. At stricter isolation
+        levels the open rental index raises the unique violation retried by
+        run_in_transaction().
+    '''
+    skipped: List[int] = []
+    while True:
+        stmt = select(inventory.c.inventory_id)\
+                .where(inventory.c.film_id == film_id, inventory.c.store_id == store_id,
+                       ~_rented_out(inventory.c.inventory_id))\
+                .order_by(inventory.c.inventory_id)\
+                .limit(1)\
+                .with_for_update(skip_locked=True, of=inventory)
+        if skipped:
+            stmt = stmt.where(inventory.c.inventory_id.not_in(skipped))
+        inventory_id = session.execute(stmt).scalar_one_or_none()
+        if inventory_id is None or not session.execute(select(_rented_out(inventory_id))).scalar_one():
+            return inventory_id
+        skipped.append(inventory_id)
+
+def rent(session: Session, film_id: int, store_id: int, customer_id: int, staff_id: int,
+         amount: Optional[Decimal] = None, rental_date: Optional[datetime] = None) -> Checkout:
+    '''
+        Allocate a copy and insert the rental and payment in the session transaction
+        without committing, see checkout().
+    '''
+    inventory_id = allocate_inventory(session, film_id, store_id)
+    if inventory_id is None:
+        raise InventoryUnavailableError(f'film {film_id} has no copy available at store {store_id}')
+    now = rental_date or datetime.utcnow()
+    paid = amount
+    if paid is None:
+        paid = session.execute(select(Film.rental_rate).where(Film.film_id == film_id)).scalar_one()
+
+    rental = Rental(rental_date=now, inventory_id=inventory_id, customer_id=customer_id,
+                    staff_id=staff_id, last_update=now)
+    session.add(rental)
+    session.flush()
+    payment = Payment(customer_id=customer_id, staff_id=staff_id, rental_id=rental.rental_id,
+                      amount=paid, payment_date=now)
+    session.add(payment)
+    session.flush()
+    rented = Checkout(rental.rental_id, payment.payment_id, inventory_id, film_id, store_id, now, paid)
+    _notify_on_commit(session, 'checked_out', rented)
+    return rented
+
+def checkout(session_factory: sessionmaker, film_id: int, store_id: int, customer_id: int, staff_id: int,
+             amount: Optional[Decimal] = None, rental_date: Optional[datetime] = None) -> Checkout:
+    '''
+        Rent a copy of the film at the store to the customer and record the payment,
+        which defaults to the rental rate of the film.
+        Raises InventoryUnavailableError when every copy is rented out or being allocated.
+    '''
+    return run_in_transaction(
+        session_factory,
+        lambda session: rent(session, film_id, store_id, customer_id, staff_id, amount, rental_date)
+    )
+
+def return_open_rental(session: Session, rental_id: int, return_date: Optional[datetime] = None) -> Return:
+    '''Mark an open rental as returned in the session transaction without committing, see return_rental()'''
+    now = return_date or datetime.utcnow()
+    inventory_id = session.execute(
+        update(Rental.__table__)
+        .where(Rental.rental_id == rental_id, Rental.return_date.is_(None))
+        .values(return_date=now, last_update=now)
+        .returning(Rental.inventory_id)
+    ).scalar_one_or_none()
+    if inventory_id is None:
+        raise RentalNotOpenError(f'rental {rental_id} is not open')
+    film_id, store_id = session.execute(
+        select(inventory.c.film_id, inventory.c.store_id).where(inventory.c.inventory_id == inventory_id)
+    ).one()
+    returned = Return(rental_id, inventory_id, film_id, store_id, now)
+    _notify_on_commit(session, 'returned', returned)
+    return returned
+
+def return_rental(session_factory: sessionmaker, rental_id: int, return_date: Optional[datetime] = None) -> Return:
+    '''
+        Mark an open rental as returned.
+        Raises RentalNotOpenError when the rental does not exist or was already returned.
+    '''
+    return run_in_transaction(session_factory, lambda session: return_open_rental(session, rental_id, return_date))
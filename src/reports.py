@@ -0,0 +1,197 @@
+'''
+    The dvdrental view reports as SQLAlchemy statements and a runner that executes
+    a set of them concurrently.
+
+    Each report runs on its own pooled connection in a thread pool, or in a process
+    pool where every worker process creates its own engine from the engine URL. The
+    per-report timeout is enforced by Postgres with a transaction local
+    statement_timeout, so a slow report is cancelled on the server instead of holding
+    the connection. Size the engine pool to at least max_workers for the thread pool.
+'''
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional
+from sqlalchemy import create_engine, select, func, case, desc, literal, text
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql import Select
+from models import Category, Film, Actor, Store, Staff
+from models import Rental, Payment, Customer, Address, City, Country
+from models import film_actor, film_category, inventory
+
+# extra seconds the caller waits for a report after its statement timeout
+TIMEOUT_GRACE = 5.0
+
+def customer_list() -> Select:
+    return select(
+        Customer.customer_id.label('id'),
+        func.concat(Customer.first_name, ' ', Customer.last_name).label('name'),
+        Address.address,
+        Address.postal_code.label('zip_code'),
+        Address.phone,
+        City.city,
+        Country.country,
+        case((Customer.activebool, 'active'), else_='').label('notes'),
+        Customer.store_id.label('sid')
+    ).select_from(Customer)\
+    .join(Address)\
+    .join(City)\
+    .join(Country)
+
+def _film_list(actor_name) -> Select:
+    return select(
+        Film.film_id.label('fid'),
+        Film.title,
+        Film.description,
+        Category.name.label('category'),
+        Film.rental_rate.label('price'),
+        Film.length,
+        Film.rating,
+        func.string_agg(actor_name, aggregate_order_by(literal(', '), Actor.last_name, Actor.first_name))\
+            .label('actors')
+    ).select_from(Category)\
+    .join(film_category)\
+    .join(Film)\
+    .join(film_actor)\
+    .join(Actor)\
+    .group_by(Film.film_id, Film.title, Film.description, Category.name, Film.rental_rate, Film.length, Film.rating)\
+    .order_by(Film.film_id)
+
+# the dvdrental views aggregate with the public.group_concat PL/pgSQL aggregate, one function
+# call per actor row, string_agg builds the same text natively. The cast is ordered by name, the
+# order of the aggregated rows would otherwise depend on the plan. filmlisting.py stores the result.
+def film_list() -> Select:
+    return _film_list(func.concat(Actor.first_name, ' ', Actor.last_name))
+
+def nicer_but_slower_film_list() -> Select:
+    return _film_list(func.concat(
+        func.upper(func.substring(Actor.first_name, 1, 1)),
+        func.lower(func.substring(Actor.first_name, 2)),
+        func.upper(func.substring(Actor.last_name, 1, 1)),
+        func.lower(func.substring(Actor.last_name, 2))
+    ))
+
+def sales_by_film_category() -> Select:
+    return select(
+        Category.name.label('category'),
+        func.sum(Payment.amount).label('total_sales')
+    ).select_from(Payment)\
+    .join(Rental)\
+    .join(inventory)\
+    .join(Film)\
+    .join(film_category)\
+    .join(Category)\
+    .group_by(Category.name)\
+    .order_by(desc(func.sum(Payment.amount)))
+
+def sales_by_store() -> Select:
+    return select(
+        func.concat(City.city, ',', Country.country).label('store'),
+        func.concat(Staff.first_name, ' ', Staff.last_name).label('manager'),
+        func.sum(Payment.amount).label('total_sales')
+    ).select_from(Payment)\
+    .join(Rental)\
+    .join(inventory)\
+    .join(Store)\
+    .join(Address)\
+    .join(City)\
+    .join(Country)\
+    .join(Staff, Staff.staff_id == Store.manager_staff_id)\
+    .group_by(Country.country, City.city, Store.store_id, Staff.first_name, Staff.last_name)\
+    .order_by(Country.country, City.city)
+
+def staff_list() -> Select:
+    return select(
+        Staff.staff_id.label('id'),
+        func.concat(Staff.first_name, ' ', Staff.last_name).label('name'),
+        Address.address,
+        Address.postal_code.label('zip_code'),
+        Address.phone,
+        City.city,
+        Country.country,
+        Staff.store_id.label('sid')
+    ).select_from(Staff)\
+    .join(Address)\
+    .join(City)\
+    .join(Country)\
+    .order_by(Staff.staff_id)
+
+REPORTS: Dict[str, Callable[[], Select]] = {
+    'customer_list': customer_list,
+    'film_list': film_list,
+    'nicer_but_slower_film_list': nicer_but_slower_film_list,
+    'sales_by_film_category': sales_by_film_category,
+    'sales_by_store': sales_by_store,
+    'staff_list': staff_list,
+}
+
+class ReportResult(NamedTuple):
+    name: str
+    rows: List[Dict[str, Any]]
+    elapsed: float
+    error: Optional[str] = None
+
+class ReportRun(NamedTuple):
+    results: Dict[str, ReportResult]
+    elapsed: float
+
+def run_report(conn: Connection, name: str, timeout: Optional[float] = None) -> List[Dict[str, Any]]:
+    with conn.begin():
+        if timeout is not None:
+            conn.execute(text("SELECT set_config('statement_timeout', :timeout, true)"),
+                         {'timeout': str(int(timeout * 1000))})
+        return [dict(row._mapping) for row in conn.execute(REPORTS[name]())]
+
+def _timed_report(engine: Engine, name: str, timeout: Optional[float]) -> ReportResult:
+    start = time.perf_counter()
+    try:
+        with engine.connect() as conn:
+            rows = run_report(conn, name, timeout)
+        return ReportResult(name, rows, time.perf_counter() - start)
+    except SQLAlchemyError as error:
+        return ReportResult(name, [], time.perf_counter() - start, str(error))
+
+_process_engines: Dict[str, Engine] = {}
+
+def _report_in_process(url: str, name: str, timeout: Optional[float]) -> ReportResult:
+    if url not in _process_engines:
+        _process_engines[url] = create_engine(url, future=True)
+    return _timed_report(_process_engines[url], name, timeout)
+
+def run_reports(engine: Engine, names: Optional[Iterable[str]] = None, max_workers: Optional[int] = None,
+                timeout: Optional[float] = None, use_processes: bool = False) -> ReportRun:
+    '''
+        Run the named reports (all of them by default) concurrently and return the rows,
+        elapsed time and error of every report plus the wall clock time of the run.
+        A report that fails or times out has an error and no rows, it does not stop the
+        other reports.
+    '''
+    names = list(names or REPORTS)
+    unknown = [name for name in names if name not in REPORTS]
+    if unknown:
+        raise ValueError(f'unknown reports: {", ".join(unknown)}')
+
+    workers = max_workers or len(names)
+    start = time.perf_counter()
+    # the statement timeout cancels slow reports on the server, the deadline only guards
+    # against workers that never return, reports queue behind each other in rounds
+    deadline = None if timeout is None else start + timeout * -(-len(names) // workers) + TIMEOUT_GRACE
+    executor = (ProcessPoolExecutor if use_processes else ThreadPoolExecutor)(max_workers=workers)
+    try:
+        if use_processes:
+            url = engine.url.render_as_string(hide_password=False)
+            futures = {name: executor.submit(_report_in_process, url, name, timeout) for name in names}
+        else:
+            futures = {name: executor.submit(_timed_report, engine, name, timeout) for name in names}
+
+        results = {}
+        for name, future in futures.items():
+            wait = None if deadline is None else max(deadline - time.perf_counter(), 0)
+            try:
+                results[name] = future.result(timeout=wait)
+            except FutureTimeoutError:
+                results[name] = ReportResult(name, [], time.perf_counter() - start, 'timed out')
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    return ReportRun(results, time.perf_counter() - start)
@@ -0,0 +1,324 @@
+'''
+    Query result cache invalidated by Postgres NOTIFY.
+
+    Results are cached under the compiled SQL of the statement plus its parameters and
+    depend on every table read while computing them: the tables of the compiled
+    statement, joined eager loads included, and of any statement run during the load
+    such as selectinload queries. Statement level triggers installed with
+    install_notify_triggers() send NOTIFY result_cache, '<table>' after every insert,
+    update, delete or truncate, so writes from any process invalidate the cache, and
+    a thread LISTENing on a dedicated connection drops the entries of that table.
+
+    Every table has a version counter bumped by each invalidation. A result is only
+    stored when the versions of its tables did not change while it was computed, so a
+    notification arriving during a query cannot leave a stale result behind. Without a
+    listening connection, before start() or while reconnecting, statements bypass the
+    cache, and the cache is emptied when the listener (re)connects since notifications
+    may have been missed.
+
+    Only results of transactions that see the latest committed rows are cached or
+    served from the cache: the statement bypasses it when the Session has pending
+    changes, when the transaction has written anything, whose rows are not committed
+    and could still be rolled back without any notification, or when it is not READ
+    COMMITTED, since REPEATABLE READ and SERIALIZABLE read an older snapshot.
+
+        cache = ResultCache(engine)
+        cache.start()
+        films = cache.execute(session, select(Film).where(Film.film_id == 1)).scalars().all()
+'''
+import select as selectors
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Any, Dict, FrozenSet, Iterable, List, NamedTuple, Optional, Set, Tuple
+from sqlalchemy import Table, TextClause, event, inspect, text
+from sqlalchemy.engine import Connection, Engine, Result
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.orm.loading import merge_frozen_result
+from sqlalchemy.sql import Executable, visitors
+
+CHANNEL = 'result_cache'
+WATCHED_TABLES = ('actor', 'address', 'category', 'city', 'country', 'customer', 'film', 'film_actor',
+                  'film_category', 'inventory', 'language', 'payment', 'rental', 'staff', 'store')
+MAX_ENTRIES = 1024
+POLL_INTERVAL = 1.0
+RECONNECT_DELAY = 5.0
+READ_COMMITTED = 'READ COMMITTED'
+READ_ONLY_STATEMENTS = ('SELECT', 'SHOW', 'EXPLAIN', 'VALUES', 'TABLE')
+# Connection.info keys, reset when the transaction ends
+WRITTEN = 'result_cache_written'
+ISOLATION = 'result_cache_isolation'
+
+class ResultCacheStats(NamedTuple):
+    hits: int
+    misses: int
+    # misses whose result was not stored because a table changed during the query
+    discarded: int
+    invalidations: int
+    entries: int
+
+def compiled_tables(compiled) -> FrozenSet[str]:
+    '''Names of the tables a compiled statement reads or writes'''
+    statement = getattr(getattr(compiled, 'compile_state', None), 'statement', None)
+    if statement is None:
+        statement = compiled.statement
+    return frozenset(element.name for element in visitors.iterate(statement) if isinstance(element, Table))
+
+def writes(context, statement: str) -> bool:
+    '''Whether an executed statement may have changed the database'''
+    if context.isinsert or context.isupdate or context.isdelete or context.isddl:
+        return True
+    compiled = context.compiled
+    if compiled is not None and not isinstance(compiled.statement, TextClause):
+        return False
+    return not statement.lstrip().upper().startswith(READ_ONLY_STATEMENTS)
+
+def install_notify_triggers(conn: Connection, tables: Iterable[str] = WATCHED_TABLES, channel: str = CHANNEL) -> None:
+    conn.execute(text(f'''
+        CREATE OR REPLACE FUNCTION public.result_cache_notify() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            PERFORM pg_notify('{channel}', TG_TABLE_NAME);
+            RETURN NULL;
+        END
+        $$'''))
+    for table in tables:
+        conn.execute(text(f'DROP TRIGGER IF EXISTS result_cache_notify ON public.{table}'))
+        conn.execute(text(
+            f'CREATE TRIGGER result_cache_notify AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON public.{table} '
+            'FOR EACH STATEMENT EXECUTE PROCEDURE public.result_cache_notify()'
+        ))
+
+def drop_notify_triggers(conn: Connection, tables: Iterable[str] = WATCHED_TABLES) -> None:
+    for table in tables:
+        conn.execute(text(f'DROP TRIGGER IF EXISTS result_cache_notify ON public.{table}'))
+    conn.execute(text('DROP FUNCTION IF EXISTS public.result_cache_notify()'))
+
+class _Entry(NamedTuple):
+    frozen: Any
+    tables: FrozenSet[str]
+
+class ResultCache():
+    def __init__(self, engine: Engine, max_entries: int = MAX_ENTRIES, channel: str = CHANNEL):
+        self.engine = engine
+        self.max_entries = max_entries
+        self.channel = channel
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[Tuple, _Entry]' = OrderedDict()
+        self._by_table: Dict[str, Set[Tuple]] = defaultdict(set)
+        self._versions: Dict[str, int] = defaultdict(int)
+        # bumped by clear(), results computed across a clear() are not stored
+        self._epoch = 0
+        self._sql: 'OrderedDict[Any, Any]' = OrderedDict()
+        self._counts: Dict[str, int] = defaultdict(int)
+        self._recording = threading.local()
+        self._ready = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        event.listen(engine, 'after_cursor_execute', self._record)
+        event.listen(engine, 'commit', self._end_transaction)
+        event.listen(engine, 'rollback', self._end_transaction)
+
+    def start(self, timeout: Optional[float] = 10.0) -> None:
+        '''Start listening and wait until notifications are received'''
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._listen, name='result-cache-listener', daemon=True)
+        self._thread.start()
+        self._ready.wait(timeout)
+
+    def stop(self) -> None:
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._thread = None
+        self.clear()
+
+    def close(self) -> None:
+        self.stop()
+        event.remove(self.engine, 'after_cursor_execute', self._record)
+        event.remove(self.engine, 'commit', self._end_transaction)
+        event.remove(self.engine, 'rollback', self._end_transaction)
+
+    def __enter__(self) -> 'ResultCache':
+        self.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    @property
+    def listening(self) -> bool:
+        return self._ready.is_set()
+
+    def _listen(self) -> None:
+        while not self._stopping.is_set():
+            raw = None
+            try:
+                raw = self.engine.raw_connection()
+                connection = raw.driver_connection
+                connection.autocommit = True
+                with connection.cursor() as cursor:
+                    cursor.execute(f'LISTEN {self.channel}')
+                self.clear()
+                self._ready.set()
+                while not self._stopping.is_set():
+                    if selectors.select([connection], [], [], POLL_INTERVAL) == ([], [], []):
+                        continue
+                    connection.poll()
+                    while connection.notifies:
+                        self.invalidate(connection.notifies.pop(0).payload)
+            except (DBAPIError, self.engine.dialect.loaded_dbapi.Error, OSError):
+                self._stopping.wait(RECONNECT_DELAY)
+            finally:
+                self._ready.clear()
+                if raw is not None:
+                    # LISTEN is session state, do not hand the connection back to the pool
+                    raw.invalidate()
+        self.clear()
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        if writes(context, statement):
+            conn.info[WRITTEN] = True
+        tables = getattr(self._recording, 'tables', None)
+        if tables is not None and context.compiled is not None:
+            tables.update(compiled_tables(context.compiled))
+
+    @staticmethod
+    def _end_transaction(conn) -> None:
+        conn.info.pop(WRITTEN, None)
+        conn.info.pop(ISOLATION, None)
+
+    @staticmethod
+    def _committed_reader(executor) -> Optional[Connection]:
+        '''Connection of the executor when its transaction reads the latest committed rows, else None'''
+        if isinstance(executor, Session):
+            if executor.new or executor.dirty or executor.deleted:
+                return None
+            conn = executor.connection()
+        else:
+            conn = executor
+        if conn.info.get(WRITTEN):
+            return None
+        isolation = conn.info.get(ISOLATION)
+        if isolation is None:
+            # one SHOW per transaction, the level cannot change once it started
+            isolation = conn.info[ISOLATION] = conn.get_isolation_level()
+        return conn if isolation == READ_COMMITTED else None
+
+    def key(self, stmt: Executable, params: Optional[Dict[str, Any]] = None) -> Optional[Tuple]:
+        '''(compiled SQL, parameters) of the statement, None when it cannot be cached'''
+        cache_key = stmt._generate_cache_key()
+        if cache_key is None:
+            return None
+        with self._lock:
+            compiled = self._sql.get(cache_key.key)
+        if compiled is None:
+            compiled = stmt.compile(dialect=self.engine.dialect, cache_key=cache_key)
+            with self._lock:
+                self._sql[cache_key.key] = compiled
+                while len(self._sql) > self.max_entries:
+                    self._sql.popitem(last=False)
+        values = compiled.construct_params(params, extracted_parameters=cache_key.bindparams, _check=False)
+        return compiled.string, tuple(sorted((name, repr(value)) for name, value in values.items()))
+
+    def execute(self, executor, stmt: Executable, params: Optional[Dict[str, Any]] = None) -> Result:
+        '''
+            Execute a SELECT on a Session or Connection through the cache. ORM results are
+            merged into the session without loading, like session.merge(load=False).
+        '''
+        conn = self._committed_reader(executor) if self.listening else None
+        key = self.key(stmt, params) if conn is not None else None
+        if key is None:
+            return executor.execute(stmt, params)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._counts['hits'] += 1
+        if entry is not None:
+            return self._result(executor, stmt, entry.frozen)
+
+        with self._lock:
+            self._counts['misses'] += 1
+            versions = dict(self._versions)
+            epoch = self._epoch
+        self._recording.tables = set()
+        try:
+            frozen = executor.execute(stmt, params).freeze()
+            tables = frozenset(self._recording.tables)
+        finally:
+            self._recording.tables = None
+        if not conn.info.get(WRITTEN):
+            self._store(key, _Entry(frozen, tables), versions, epoch)
+        return self._result(executor, stmt, frozen)
+
+    @staticmethod
+    def _result(executor, stmt: Executable, frozen) -> Result:
+        if isinstance(executor, Session) and stmt._propagate_attrs.get('compile_state_plugin') == 'orm':
+            return merge_frozen_result(executor, stmt, frozen, load=False)()
+        return frozen()
+
+    def _store(self, key: Tuple, entry: _Entry, versions: Dict[str, int], epoch: int) -> None:
+        with self._lock:
+            if epoch != self._epoch or any(self._versions[table] != versions.get(table, 0) for table in entry.tables):
+                self._counts['discarded'] += 1
+                return
+            self._entries[key] = entry
+            for table in entry.tables:
+                self._by_table[table].add(key)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, key: Tuple) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            for table in entry.tables:
+                self._by_table[table].discard(key)
+
+    def invalidate(self, table: str) -> None:
+        '''Drop the results depending on the table'''
+        with self._lock:
+            self._versions[table] += 1
+            self._counts['invalidations'] += 1
+            for key in list(self._by_table.pop(table, ())):
+                self._drop(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+            self._by_table.clear()
+
+    def watch_sessions(self, session_factory: sessionmaker) -> None:
+        '''
+            Invalidate the tables written by sessions of the factory as soon as they commit,
+            so the session reads its own writes before the notification comes back.
+        '''
+        @event.listens_for(session_factory, 'after_flush')
+        def _after_flush(session, flush_context):
+            written = session.info.setdefault('result_cache_tables', set())
+            for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+                mapper = inspect(instance).mapper
+                written.update(table.name for table in mapper.tables)
+                written.update(relationship.secondary.name for relationship in mapper.relationships
+                               if relationship.secondary is not None)
+
+        @event.listens_for(session_factory, 'after_commit')
+        def _after_commit(session):
+            for table in session.info.pop('result_cache_tables', ()):
+                self.invalidate(table)
+
+        @event.listens_for(session_factory, 'after_rollback')
+        def _after_rollback(session):
+            session.info.pop('result_cache_tables', None)
+
+    def stats(self) -> ResultCacheStats:
+        with self._lock:
+            return ResultCacheStats(self._counts['hits'], self._counts['misses'], self._counts['discarded'],
+                                    self._counts['invalidations'], len(self._entries))
+
+    def tables_of(self, stmt: Executable, params: Optional[Dict[str, Any]] = None) -> List[str]:
+        '''Tables the cached result of the statement depends on, empty when it is not cached'''
+        key = self.key(stmt, params)
+        with self._lock:
+            entry = self._entries.get(key)
+        return sorted(entry.tables) if entry is not None else []
@@ -0,0 +1,242 @@
+'''
+    Daily, weekly and monthly revenue rollups per store, staff and category.
+
+    The revenue_daily, revenue_weekly and revenue_monthly tables hold the amount and
+    number of payments per (period, store_id, staff_id), the revenue_category_daily,
+    revenue_category_weekly and revenue_category_monthly tables per (period, store_id,
+    staff_id, category_id). An AFTER INSERT trigger on payment adds every new payment to
+    all of them, rebuild_rollups() recomputes a date range from payment for payments
+    updated or deleted after the fact. The store is the store of the rented inventory
+    copy and the category comes from film_category, like the sales_by_store and
+    sales_by_film_category views. A film can have no category or several, so only the
+    category rollups join film_category: a payment counts once in the store and staff
+    totals, and once in each category of its film.
+
+    revenue() splits the requested range into the coarsest periods it fully covers,
+    whole months, then whole weeks and days around them, and reads raw payments only
+    for the partial days at the two edges.
+'''
+from datetime import date, datetime, time, timedelta
+from typing import List, NamedTuple, Optional, Sequence, Union
+from sqlalchemy import Column, Date, Integer, MetaData, Numeric, Table, cast, delete, func, insert, \
+    select, text, union_all
+from sqlalchemy.engine import Connection, Row
+from sqlalchemy.sql import Select
+from models import Payment, Rental, inventory, film_category
+from partitions import next_month
+
+DateLike = Union[date, datetime]
+
+GRAINS = ('month', 'week', 'day')
+DIMENSIONS = ('store_id', 'staff_id', 'category_id')
+
+metadata = MetaData(schema='public')
+
+def _rollup_table(name: str, keys: Sequence[str]) -> Table:
+    return Table(
+        name,
+        metadata,
+        Column('period', Date, primary_key=True),
+        *(Column(key, Integer, primary_key=True) for key in keys),
+        Column('amount', Numeric(12, 2), nullable=False),
+        Column('payments', Integer, nullable=False),
+    )
+
+ROLLUP_KEYS = ('store_id', 'staff_id')
+CATEGORY_ROLLUP_KEYS = DIMENSIONS
+
+ROLLUP_TABLES = {
+    'day': _rollup_table('revenue_daily', ROLLUP_KEYS),
+    'week': _rollup_table('revenue_weekly', ROLLUP_KEYS),
+    'month': _rollup_table('revenue_monthly', ROLLUP_KEYS),
+}
+CATEGORY_ROLLUP_TABLES = {
+    'day': _rollup_table('revenue_category_daily', CATEGORY_ROLLUP_KEYS),
+    'week': _rollup_table('revenue_category_weekly', CATEGORY_ROLLUP_KEYS),
+    'month': _rollup_table('revenue_category_monthly', CATEGORY_ROLLUP_KEYS),
+}
+
+class Segment(NamedTuple):
+    '''[start, end) read from the rollup of grain, or from payment when grain is 'raw' '''
+    grain: str
+    start: datetime
+    end: datetime
+
+def _as_datetime(value: DateLike) -> datetime:
+    return value if isinstance(value, datetime) else datetime.combine(value, time.min)
+
+def truncate(value: DateLike, grain: str) -> datetime:
+    '''Start of the day, ISO week (Monday) or month containing value, like date_trunc'''
+    day = datetime.combine(_as_datetime(value).date(), time.min)
+    if grain == 'day':
+        return day
+    if grain == 'week':
+        return day - timedelta(days=day.weekday())
+    if grain == 'month':
+        return day.replace(day=1)
+    raise ValueError(f'unknown grain {grain!r}')
+
+def advance(value: datetime, grain: str) -> datetime:
+    '''Start of the period following the one starting at value'''
+    if grain == 'day':
+        return value + timedelta(days=1)
+    if grain == 'week':
+        return value + timedelta(weeks=1)
+    return datetime.combine(next_month(value), time.min)
+
+def _ceil(value: datetime, grain: str) -> datetime:
+    start = truncate(value, grain)
+    return start if start == value else advance(start, grain)
+
+def plan(start: DateLike, end: DateLike, grains: Sequence[str] = GRAINS) -> List[Segment]:
+    '''Cover [start, end) with the coarsest whole periods, finer ones towards the edges'''
+    start, end = _as_datetime(start), _as_datetime(end)
+    if start >= end:
+        return []
+    if not grains:
+        return [Segment('raw', start, end)]
+    grain, finer = grains[0], grains[1:]
+    inner_start, inner_end = _ceil(start, grain), truncate(end, grain)
+    if inner_start >= inner_end:
+        return plan(start, end, finer)
+    return plan(start, inner_start, finer) + [Segment(grain, inner_start, inner_end)] + plan(inner_end, end, finer)
+
+def _payments(by_category: bool = False) -> Select:
+    '''Payments with the store they count towards, once per category of the film when by_category'''
+    stmt = select(Payment.payment_date, Payment.amount, Payment.staff_id, inventory.c.store_id)\
+            .join(Rental, Rental.rental_id == Payment.rental_id)\
+            .join(inventory, inventory.c.inventory_id == Rental.inventory_id)
+    if by_category:
+        stmt = stmt.add_columns(film_category.c.category_id)\
+                .join(film_category, film_category.c.film_id == inventory.c.film_id)
+    return stmt
+
+def _period(grain: str, column):
+    return cast(func.date_trunc(grain, column), Date)
+
+def _check_dimensions(dimensions: Sequence[str]) -> None:
+    unknown = [name for name in dimensions if name not in DIMENSIONS]
+    if unknown:
+        raise ValueError(f'unknown dimensions: {", ".join(unknown)}')
+
+def _segment_select(segment: Segment, dimensions: Sequence[str], series_grain: Optional[str] = None) -> Select:
+    by_category = 'category_id' in dimensions
+    if segment.grain == 'raw':
+        source = _payments(by_category).where(Payment.payment_date >= segment.start, Payment.payment_date < segment.end).subquery()
+        columns = [source.c[name] for name in dimensions]
+        if series_grain:
+            columns.insert(0, _period(series_grain, source.c.payment_date).label('period'))
+        return select(*columns, func.sum(source.c.amount).label('amount'), func.count().label('payments'))\
+                .group_by(*columns)
+    table = (CATEGORY_ROLLUP_TABLES if by_category else ROLLUP_TABLES)[segment.grain]
+    columns = [table.c[name] for name in dimensions]
+    if series_grain:
+        columns.insert(0, table.c.period)
+    return select(*columns, func.sum(table.c.amount).label('amount'), func.sum(table.c.payments).label('payments'))\
+            .where(table.c.period >= segment.start.date(), table.c.period < segment.end.date())\
+            .group_by(*columns)
+
+def _combine(parts: List[Select], columns: Sequence[str]) -> Select:
+    combined = union_all(*parts).subquery()
+    keys = [combined.c[name] for name in columns]
+    return select(*keys, func.sum(combined.c.amount).label('amount'),
+                  cast(func.sum(combined.c.payments), Integer).label('payments'))\
+            .group_by(*keys)\
+            .order_by(*keys)
+
+def revenue(conn: Connection, start: DateLike, end: DateLike, dimensions: Sequence[str] = ()) -> List[Row]:
+    '''
+        Rows of (*dimensions, amount, payments) for the payments in [start, end), e.g.
+        revenue(conn, date(2007, 3, 1), date(2007, 4, 1), ('store_id',)) only reads the
+        March rows of revenue_monthly.
+    '''
+    _check_dimensions(dimensions)
+    segments = plan(start, end)
+    if not segments:
+        return []
+    return conn.execute(_combine([_segment_select(segment, dimensions) for segment in segments], dimensions)).all()
+
+def revenue_series(conn: Connection, grain: str, start: DateLike, end: DateLike,
+                   dimensions: Sequence[str] = ()) -> List[Row]:
+    '''
+        Rows of (period, *dimensions, amount, payments) per day, week or month for a
+        trend chart. Periods only partly inside [start, end) are summed from payment.
+    '''
+    _check_dimensions(dimensions)
+    start, end = _as_datetime(start), _as_datetime(end)
+    if grain not in ROLLUP_TABLES:
+        raise ValueError(f'unknown grain {grain!r}')
+    inner_start, inner_end = _ceil(start, grain), truncate(end, grain)
+    if inner_start >= inner_end:
+        segments = [Segment('raw', start, end)]
+    else:
+        segments = [Segment('raw', start, inner_start), Segment(grain, inner_start, inner_end), Segment('raw', inner_end, end)]
+    parts = [_segment_select(segment, dimensions, grain) for segment in segments if segment.start < segment.end]
+    if not parts:
+        return []
+    return conn.execute(_combine(parts, ('period',) + tuple(dimensions))).all()
+
+def rebuild_rollups(conn: Connection, start: DateLike, end: DateLike) -> None:
+    '''
+        Recompute the rollups of every period overlapping [start, end) from payment.
+        Run it after payments were updated or deleted, or to backfill.
+    '''
+    for tables, keys, by_category in ((ROLLUP_TABLES, ROLLUP_KEYS, False),
+                                      (CATEGORY_ROLLUP_TABLES, CATEGORY_ROLLUP_KEYS, True)):
+        for grain, table in tables.items():
+            lower, upper = truncate(start, grain), _ceil(_as_datetime(end), grain)
+            conn.execute(delete(table).where(table.c.period >= lower.date(), table.c.period < upper.date()))
+            source = _payments(by_category).where(Payment.payment_date >= lower, Payment.payment_date < upper)\
+                    .subquery()
+            period = _period(grain, source.c.payment_date)
+            dimensions = [source.c[name] for name in keys]
+            conn.execute(insert(table).from_select(
+                ['period', *keys, 'amount', 'payments'],
+                select(period, *dimensions, func.sum(source.c.amount), func.count()).group_by(period, *dimensions)
+            ))
+
+def _trigger_function() -> str:
+    statements = []
+    for grain, table in ROLLUP_TABLES.items():
+        statements.append(f'''
+        INSERT INTO {table.schema}.{table.name} AS t (period, store_id, staff_id, amount, payments)
+        SELECT date_trunc('{grain}', NEW.payment_date)::date, i.store_id, NEW.staff_id, NEW.amount, 1
+        FROM public.rental r
+        JOIN public.inventory i ON i.inventory_id = r.inventory_id
+        WHERE r.rental_id = NEW.rental_id
+        ON CONFLICT (period, store_id, staff_id)
+        DO UPDATE SET amount = t.amount + EXCLUDED.amount, payments = t.payments + 1;''')
+    for grain, table in CATEGORY_ROLLUP_TABLES.items():
+        statements.append(f'''
+        INSERT INTO {table.schema}.{table.name} AS t (period, store_id, staff_id, category_id, amount, payments)
+        SELECT date_trunc('{grain}', NEW.payment_date)::date, i.store_id, NEW.staff_id, fc.category_id, NEW.amount, 1
+        FROM public.rental r
+        JOIN public.inventory i ON i.inventory_id = r.inventory_id
+        JOIN public.film_category fc ON fc.film_id = i.film_id
+        WHERE r.rental_id = NEW.rental_id
+        ON CONFLICT (period, store_id, staff_id, category_id)
+        DO UPDATE SET amount = t.amount + EXCLUDED.amount, payments = t.payments + 1;''')
+    return f'''
+    CREATE OR REPLACE FUNCTION public.payment_revenue_rollup() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN{''.join(statements)}
+        RETURN NULL;
+    END
+    $$'''
+
+def create_rollups(conn: Connection) -> None:
+    '''Create the rollup tables and the payment trigger and fill them from the existing payments'''
+    metadata.create_all(conn)
+    conn.execute(text(_trigger_function()))
+    conn.execute(text('DROP TRIGGER IF EXISTS payment_revenue_rollup_trigger ON public.payment'))
+    conn.execute(text(
+        'CREATE TRIGGER payment_revenue_rollup_trigger AFTER INSERT ON public.payment '
+        'FOR EACH ROW EXECUTE PROCEDURE public.payment_revenue_rollup()'
+    ))
+    first, last = conn.execute(select(func.min(Payment.payment_date), func.max(Payment.payment_date))).one()
+    if first is not None:
+        rebuild_rollups(conn, first, last + timedelta(microseconds=1))
+
+def drop_rollups(conn: Connection) -> None:
+    conn.execute(text('DROP TRIGGER IF EXISTS payment_revenue_rollup_trigger ON public.payment'))
+    conn.execute(text('DROP FUNCTION IF EXISTS public.payment_revenue_rollup()'))
+    metadata.drop_all(conn)
@@ -0,0 +1,129 @@
+'''
+    Recency, frequency and monetary (RFM) segmentation of the customers.
+
+    One grouped query returns the last payment date, number of payments and total
+    paid of every customer as columns, NumPy turns each column into quintile scores
+    from 1 to 5 (5 being the most recent, most frequent and biggest spender) and
+    labels the segments, and the scores are written to customer_segment with an
+    executemany upsert, which SQLAlchemy sends as multi row INSERT ... ON CONFLICT
+    statements of up to 1000 rows each. The scores live in their own table rather
+    than in columns of customer, so scoring never rewrites or locks customer rows.
+'''
+from datetime import datetime
+from typing import NamedTuple, Optional, Sequence
+import numpy as np
+from sqlalchemy import Column, Integer, MetaData, Numeric, String, Table, TIMESTAMP, func, select, SmallInteger
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.engine import Connection
+from models import Customer, Payment
+
+QUANTILES = 5
+
+metadata = MetaData(schema='public')
+
+customer_segment = Table(
+    'customer_segment',
+    metadata,
+    Column('customer_id', Integer, primary_key=True),
+    Column('recency_days', Integer),
+    Column('frequency', Integer, nullable=False),
+    Column('monetary', Numeric(9, 2), nullable=False),
+    Column('r_score', SmallInteger, nullable=False),
+    Column('f_score', SmallInteger, nullable=False),
+    Column('m_score', SmallInteger, nullable=False),
+    Column('segment', String(20), nullable=False),
+    Column('scored_at', TIMESTAMP, nullable=False),
+)
+
+# first matching rule wins, see label()
+SEGMENTS = ('champions', 'loyal', 'new', 'at_risk', 'lost', 'regular')
+
+class RFMScores(NamedTuple):
+    customer_ids: np.ndarray
+    # days since the last payment, NaN for customers who never paid
+    recency: np.ndarray
+    frequency: np.ndarray
+    monetary: np.ndarray
+    r: np.ndarray
+    f: np.ndarray
+    m: np.ndarray
+    segments: np.ndarray
+    as_of: datetime
+
+def quantile_scores(values: np.ndarray, quantiles: int = QUANTILES, reverse: bool = False) -> np.ndarray:
+    '''
+        Score from 1 to quantiles by the percentile rank of each value, equal values share
+        their average rank. reverse gives the highest score to the lowest values. NaN scores 1.
+    '''
+    known = ~np.isnan(values)
+    scores = np.ones(len(values), dtype=np.int16)
+    if not known.any():
+        return scores
+    _, inverse, counts = np.unique(values[known], return_inverse=True, return_counts=True)
+    average_rank = np.cumsum(counts) - (counts - 1) / 2
+    ranked = np.clip(np.ceil(average_rank[inverse] / known.sum() * quantiles), 1, quantiles).astype(np.int16)
+    scores[known] = quantiles + 1 - ranked if reverse else ranked
+    return scores
+
+def label(r: np.ndarray, f: np.ndarray, m: np.ndarray) -> np.ndarray:
+    conditions = [
+        (r >= 4) & (f >= 4) & (m >= 4),
+        (r >= 3) & (f >= 4),
+        (r >= 4) & (f <= 2),
+        (r <= 2) & (f >= 3),
+        r <= 2,
+    ]
+    return np.select(conditions, SEGMENTS[:-1], default=SEGMENTS[-1])
+
+def score_customers(conn: Connection, as_of: Optional[datetime] = None, quantiles: int = QUANTILES) -> RFMScores:
+    '''Scores of every customer, recency counted up to as_of which defaults to the last payment date'''
+    rows = conn.execute(
+        select(Customer.customer_id, func.max(Payment.payment_date), func.count(Payment.payment_id),
+               func.coalesce(func.sum(Payment.amount), 0))
+        .select_from(Customer)
+        .outerjoin(Payment, Payment.customer_id == Customer.customer_id)
+        .group_by(Customer.customer_id)
+        .order_by(Customer.customer_id)
+    ).all()
+    customer_ids, last_payments, frequency, monetary = zip(*rows) if rows else ((), (), (), ())
+    if as_of is None:
+        as_of = max((last for last in last_payments if last is not None), default=datetime.utcnow())
+
+    last = np.array([np.datetime64(value) if value is not None else np.datetime64('NaT') for value in last_payments],
+                    dtype='datetime64[us]')
+    recency = (np.datetime64(as_of, 'us') - last) / np.timedelta64(1, 'D')
+    frequency = np.array(frequency, dtype=np.int64)
+    monetary = np.array(monetary, dtype=np.float64)
+    r = quantile_scores(recency, quantiles, reverse=True)
+    f = quantile_scores(frequency.astype(np.float64), quantiles)
+    m = quantile_scores(monetary, quantiles)
+    return RFMScores(np.array(customer_ids, dtype=np.int64), recency, frequency, monetary, r, f, m,
+                     label(r, f, m), as_of)
+
+def write_segments(conn: Connection, scores: RFMScores) -> int:
+    '''Upsert the scores into customer_segment (created if missing) and return the number of rows'''
+    metadata.create_all(conn)
+    now = datetime.utcnow()
+    rows = [
+        {
+            'customer_id': int(customer_id),
+            'recency_days': None if np.isnan(recency) else int(recency),
+            'frequency': int(frequency),
+            'monetary': round(float(monetary), 2),
+            'r_score': int(r), 'f_score': int(f), 'm_score': int(m),
+            'segment': str(segment),
+            'scored_at': now,
+        }
+        for customer_id, recency, frequency, monetary, r, f, m, segment in zip(
+            scores.customer_ids, scores.recency, scores.frequency, scores.monetary,
+            scores.r, scores.f, scores.m, scores.segments)
+    ]
+    if not rows:
+        return 0
+    stmt = insert(customer_segment)
+    updated: Sequence[str] = [column.name for column in customer_segment.columns if column.name != 'customer_id']
+    conn.execute(stmt.on_conflict_do_update(
+        index_elements=[customer_segment.c.customer_id],
+        set_={name: stmt.excluded[name] for name in updated}
+    ), rows)
+    return len(rows)
@@ -1,8 +1,11 @@
 from uuid import uuid4
+import os
 import time
 import docker
 import pytest
-
+from sqlalchemy import delete
+from sqlalchemy.engine import Engine
+from models import Payment, Rental
 
 
 @pytest.fixture(scope='session')
@@ -24,6 +27,9 @@ def setup_dvdrental_db_docker_image(session_uuid: str, root_directory: str):
         tag=f'unit-test-sqlaclchemy:{session_uuid}',
         nocache=True,
         rm=True,
+        buildargs={
+            'DVDRENTAL_PROVISION': os.environ.get('DVDRENTAL_PROVISION', 'restore')
+        },
         labels={
             'test-image-tag': f'unit-test-sqlaclchemy:{session_uuid}'
         }
@@ -60,3 +66,16 @@ def setup_dvdrental_db_docker_image(session_uuid: str, root_directory: str):
     client.images.remove(dvdrental_db_image.labels["test-image-tag"])
 
     print('Session level - done with cleaning up docker container and image.')
+
+@pytest.fixture(scope='function')
+def checkouts(engine: Engine):
+    '''
+        The checkout service commits its own transactions, the test appends the rentals
+        it creates and they are deleted again with their payments when the test finishes.
+    '''
+    created = []
+    yield created
+    with engine.begin() as conn:
+        rental_ids = [c.rental_id for c in created]
+        conn.execute(delete(Payment.__table__).where(Payment.rental_id.in_(rental_ids)))
+        conn.execute(delete(Rental.__table__).where(Rental.rental_id.in_(rental_ids)))
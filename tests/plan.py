@@ -0,0 +1,61 @@
+'''
+    EXPLAIN helpers for asserting that statements are served by the indexes we rely on.
+
+    The sample tables are small enough that the planner prefers a sequential scan for
+    most queries, so explain(..., disable_seqscan=True) makes sequential scans cost
+    prohibitive for the statement: when a plan still contains one, no usable index
+    exists for it.
+'''
+from typing import Any, Dict, Iterator, List, Set
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql import Executable
+
+class Plan():
+    def __init__(self, plan: Dict[str, Any]):
+        self.root = plan
+
+    def nodes(self) -> Iterator[Dict[str, Any]]:
+        pending = [self.root]
+        while pending:
+            node = pending.pop()
+            yield node
+            pending.extend(node.get('Plans', []))
+
+    def index_names(self) -> Set[str]:
+        return {node['Index Name'] for node in self.nodes() if 'Index Name' in node}
+
+    def seq_scans(self) -> Set[str]:
+        '''Names of the tables read with a sequential scan'''
+        return {node['Relation Name'] for node in self.nodes() if node['Node Type'] == 'Seq Scan'}
+
+    @property
+    def rows(self) -> int:
+        '''Estimated number of rows returned'''
+        return self.root['Plan Rows']
+
+    def __repr__(self) -> str:
+        return f'Plan(indexes={sorted(self.index_names())}, seq_scans={sorted(self.seq_scans())}, rows={self.rows})'
+
+def explain(conn: Connection, stmt: Executable, disable_seqscan: bool = False) -> Plan:
+    '''
+        EXPLAIN (FORMAT JSON) the statement with its bound parameters. enable_seqscan is
+        only changed for the EXPLAIN and set back afterwards.
+    '''
+    compiled = stmt.compile(dialect=conn.dialect, compile_kwargs={'render_postcompile': True})
+    previous = conn.exec_driver_sql('SHOW enable_seqscan').scalar_one()
+    if disable_seqscan:
+        conn.exec_driver_sql("SELECT set_config('enable_seqscan', 'off', true)")
+    try:
+        document: List[Dict[str, Any]] = conn.exec_driver_sql(f'EXPLAIN (FORMAT JSON) {compiled}', compiled.params).scalar_one()
+    finally:
+        conn.exec_driver_sql('SELECT set_config(%(name)s, %(value)s, true)', {'name': 'enable_seqscan', 'value': previous})
+    return Plan(document[0]['Plan'])
+
+def assert_index_used(plan: Plan, index_name: str) -> None:
+    assert index_name in plan.index_names(), f'{index_name} not used: {plan}'
+
+def assert_no_seq_scan(plan: Plan, table_name: str) -> None:
+    assert table_name not in plan.seq_scans(), f'sequential scan on {table_name}: {plan}'
+
+def assert_rows_at_most(plan: Plan, bound: int) -> None:
+    assert plan.rows <= bound, f'estimated {plan.rows} rows, expected at most {bound}: {plan}'